@@ -1,17 +1,142 @@
 import argparse
 import os
+import sys
 import json
 
 import openai
 from tqdm import tqdm
 
-from llm.chatgpt import init_chatgpt, ask_llm
+from llm.batch_job import export_requests, load_results
+from llm.batcher import pack_prompts
+from llm.chatgpt import init_chatgpt, init_rate_limiter, init_cache, init_metrics, ask_llm, estimate_tokens
+from llm.dispatcher import ordered_map, ordered_pipeline
 from utils.enums import LLM
-from torch.utils.data import DataLoader
 
-from utils.post_process import process_duplication, get_sqls
+from utils.journal import Journal
+from utils.post_process import clean_sql, get_sqls, DenotationVoter, configure_execution, get_exec_stats
 
 QUESTION_FILE = "questions.json"
+CACHE_FILE = "llm_cache.sqlite"
+
+
+def empty_response(n, size):
+    if n == 1:
+        return {"response": [""] * size, "total_tokens": 0}
+    else:
+        return {"response": [[""] for _ in range(size)], "total_tokens": 0}
+
+
+def parse_answers(indices, res, args, db_ids):
+    """Post-process the responses to the questions in indices and return one journal record per question."""
+    records = []
+    for index, responses in zip(indices, res["response"]):
+        if args.n == 1:
+            sql = clean_sql(responses)
+        elif args.exec_workers > 1:
+            # voted on together with all other questions at the end of the run, see vote_deferred
+            sql = None
+        else:
+            processed_sqls = [clean_sql(sql) for sql in responses]
+            result = {
+                'db_id': db_ids[index],
+                'p_sqls': processed_sqls
+            }
+            sql = get_sqls([result], args.n, args.db_dir)[0]
+        records.append({
+            "index": index,
+            "db_id": db_ids[index],
+            "responses": responses,
+            "sql": sql
+        })
+    return records
+
+
+def vote_deferred(journal, args):
+    """Vote on every journaled question left without a SQL at once, in a pool of args.exec_workers processes
+    (in this process with at most 1)."""
+    records = journal.load()
+    pending = [index for index in sorted(records) if records[index]["sql"] is None]
+    if not pending:
+        return
+    results = [{
+        "db_id": records[index]["db_id"],
+        "p_sqls": [clean_sql(sql) for sql in records[index]["responses"]]
+    } for index in pending]
+    print(f"Vote on {len(pending)} questions with {max(args.exec_workers, 1)} processes")
+    chosen_sqls = get_sqls(results, args.n, args.db_dir, num_workers=args.exec_workers)
+    journal.open()
+    try:
+        for index, sql in zip(pending, chosen_sqls):
+            records[index]["sql"] = sql
+            journal.append(records[index])
+    finally:
+        journal.close()
+
+
+def generate_batch(indices, args, questions):
+    """Ask the LLM for one batch of questions, given by their indices."""
+    batch = [questions[index] for index in indices]
+    try:
+        res = ask_llm(args.model, batch, args.temperature, args.n)
+    except openai.error.InvalidRequestError:
+        print(f"The {indices[0]}-th question has too much tokens! Return \"SELECT\" instead")
+        res = empty_response(args.n, len(batch))
+    return indices, res
+
+
+def vote_batch(indices, res, args, db_ids):
+    """Post-process (and vote on) the responses to one batch and return one journal record per question."""
+    return parse_answers(indices, res, args, db_ids), res["total_tokens"]
+
+
+def answer_adaptive(indices, args, questions, db_ids):
+    """Ask for self-consistency samples of one question in small rounds until the vote can't change any more."""
+    index = indices[0]
+    batch = [questions[index]]
+    db_id = db_ids[index]
+    voter = DenotationVoter(f"{args.db_dir}/{db_id}/{db_id}")
+    responses = []
+    token_cnt = 0
+    # a vote can't be decided before a majority of the n samples agree
+    n_request = args.n // 2 + 1
+    sample_round = 0
+    while True:
+        try:
+            res = ask_llm(args.model, batch, args.temperature, n_request, sample_round=sample_round)
+        except openai.error.InvalidRequestError:
+            print(f"The {index}-th question has too much tokens! Return \"SELECT\" instead")
+            responses.append("")
+            voter.add(clean_sql(""))
+            break
+        samples = res["response"][0]
+        if isinstance(samples, str):
+            samples = [samples]
+        token_cnt += res["total_tokens"]
+        for sample in samples:
+            responses.append(sample)
+            voter.add(clean_sql(sample))
+
+        n_remaining = args.n - len(responses)
+        if n_remaining <= 0 or voter.is_decided(n_remaining):
+            break
+        n_request = min(args.sc_step, n_remaining)
+        sample_round += 1
+
+    record = {
+        "index": index,
+        "db_id": db_id,
+        "responses": responses,
+        "sql": voter.vote()
+    }
+    return [record], token_cnt
+
+
+def ingest_answer(index, res, args, db_ids):
+    """Post-process the response of a batch job to one question."""
+    if res is None:
+        print(f"The {index}-th question has no result in the batch job! Return \"SELECT\" instead")
+        res = empty_response(args.n, 1)
+    return parse_answers([index], res, args, db_ids), res["total_tokens"]
 
 
 if __name__ == '__main__':
@@ -19,6 +144,7 @@ if __name__ == '__main__':
     parser.add_argument("--question", type=str)
     parser.add_argument("--openai_api_key", type=str)
     parser.add_argument("--openai_group_id", type=str, default="org-ktBefi7n9aK7sZjwc2R9G1Wo")
+    parser.add_argument("--openai_api_base", type=str, default=None, help="Send requests to another OpenAI-compatible server")
     parser.add_argument("--model", type=str, choices=[LLM.TEXT_DAVINCI_003, 
                                                       LLM.GPT_35_TURBO,
                                                       LLM.GPT_35_TURBO_0613,
@@ -26,26 +152,71 @@ if __name__ == '__main__':
                                                       LLM.GPT_35_TURBO_16K,
                                                       LLM.GPT_4],
                         default=LLM.GPT_35_TURBO)
-    parser.add_argument("--start_index", type=int, default=0)
-    parser.add_argument("--end_index", type=int, default=1000000)
+    parser.add_argument("--start_index", type=int, default=0, help="Index of the first question to ask")
+    parser.add_argument("--end_index", type=int, default=1000000, help="Index after the last question to ask")
     parser.add_argument("--temperature", type=float, default=0)
     parser.add_argument("--mini_index_path", type=str, default="")
-    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=1, help="Maximal number of prompts per request")
+    parser.add_argument("--batch_tokens", type=int, default=0,
+                        help="Maximal estimated tokens (prompts and answers) per request when batch_size > 1, 0 for no limit")
     parser.add_argument("--n", type=int, default=5, help="Size of self-consistent set")
     parser.add_argument("--db_dir", type=str, default="dataset/spider/database")
+    parser.add_argument("--db_pool_size", type=int, default=None, help="Read-only database connections kept open per vote worker")
+    parser.add_argument("--db_mmap_size", type=int, default=None, help="Bytes of each database to memory-map while voting")
+    parser.add_argument("--db_snapshot_bytes", type=int, default=None,
+                        help="Bytes of databases each vote worker keeps in memory, larger ones are read from disk")
+    parser.add_argument("--exec_max_rows", type=int, default=None,
+                        help="Rows of a candidate's result kept while voting, 0 for no limit")
+    parser.add_argument("--exec_max_bytes", type=int, default=None,
+                        help="Approximate bytes of a candidate's result kept while voting, 0 for no limit")
+    parser.add_argument("--exec_cache", type=str, default=None,
+                        help="SQLite file caching execution results across runs, disabled by default")
+    parser.add_argument("--exec_timeout", type=float, default=None, help="Seconds a candidate may run while voting, 0 for no limit")
+    parser.add_argument("--exec_max_instructions", type=int, default=None,
+                        help="SQLite VM instructions a candidate may run while voting, 0 for no limit")
+    parser.add_argument("--adaptive_sc", action="store_true",
+                        help="Request self-consistency samples in rounds and stop once the vote is decided")
+    parser.add_argument("--sc_step", type=int, default=1, help="Samples requested per round after the first with --adaptive_sc")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of requests kept in flight")
+    parser.add_argument("--vote_workers", type=int, default=1,
+                        help="Number of threads executing and voting on candidates while the next requests are in flight")
+    parser.add_argument("--exec_workers", type=int, default=1,
+                        help="With more than 1, vote on all questions at once after the LLM calls, in this many processes")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests-per-minute quota, 0 for unlimited")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens-per-minute quota, 0 for unlimited")
+    parser.add_argument("--cache", type=str, default=None, help=f"Path of the response cache, [question]/{CACHE_FILE} by default")
+    parser.add_argument("--no_cache", action="store_true", help="Always call the API")
+    parser.add_argument("--resume", action="store_true", help="Skip the questions finished in the journal of a previous run")
+    parser.add_argument("--mode", type=str, choices=["call", "export", "ingest"], default="call",
+                        help="Call the API directly, or export requests for / ingest results of an OpenAI batch job")
+    parser.add_argument("--batch_file", type=str, default=None,
+                        help="Request file to export (BATCH_REQUESTS_MODEL-[model].jsonl in [question] by default), or result file to ingest")
     args = parser.parse_args()
 
     # check args
     assert args.model in LLM.BATCH_FORWARD or \
            args.model not in LLM.BATCH_FORWARD and args.batch_size == 1, \
         f"{args.model} doesn't support batch_size > 1"
+    assert not args.adaptive_sc or args.model in LLM.TASK_CHAT and args.n > 1, \
+        "--adaptive_sc needs a chat model and n > 1"
+    assert args.model not in LLM.TASK_COMPLETIONS or args.n == 1, \
+        f"{args.model} is a completion model and doesn't support self-consistency, use --n 1"
 
     questions_json = json.load(open(os.path.join(args.question, QUESTION_FILE), "r"))
     questions = [_["prompt"] for _ in questions_json["questions"]]
     db_ids = [_["db_id"] for _ in questions_json["questions"]]
 
+    configure_execution(pool_size=args.db_pool_size, mmap_size=args.db_mmap_size, snapshot_bytes=args.db_snapshot_bytes,
+                        timeout=args.exec_timeout, max_instructions=args.exec_max_instructions,
+                        max_rows=args.exec_max_rows, max_bytes=args.exec_max_bytes, cache_path=args.exec_cache)
+
     # init openai api
-    init_chatgpt(args.openai_api_key, args.openai_group_id, args.model)
+    init_chatgpt(args.openai_api_key, args.openai_group_id, args.model, args.openai_api_base)
+    init_rate_limiter(args.rpm, args.tpm)
+    if args.no_cache or args.mode != "call":
+        cache = None
+    else:
+        cache = init_cache(args.cache or os.path.join(args.question, CACHE_FILE))
 
     if args.start_index == 0:
         mode = "w"
@@ -55,60 +226,102 @@ if __name__ == '__main__':
     if args.mini_index_path:
         mini_index = json.load(open(args.mini_index_path, 'r'))
         questions = [questions[i] for i in mini_index]
+        db_ids = [db_ids[i] for i in mini_index]
         out_file = f"{args.question}/RESULTS_MODEL-{args.model}_MINI.txt"
     else:
         out_file = f"{args.question}/RESULTS_MODEL-{args.model}.txt"
 
-    question_loader = DataLoader(questions, batch_size=args.batch_size, shuffle=False, drop_last=False)
+    # every finished question is journaled, so an interrupted run can be resumed exactly
+    journal = Journal(out_file + ".journal")
+    finished = journal.load() if args.resume else dict()
+
+    indices = [index for index in range(len(questions))
+               if args.start_index <= index < args.end_index and index not in finished]
+    if args.resume:
+        print(f"Resume: {len(finished)} questions finished, {len(indices)} questions left")
 
+    if args.mode == "export":
+        # batch jobs have one request per question
+        mini_suffix = "_MINI" if args.mini_index_path else ""
+        batch_file = args.batch_file or f"{args.question}/BATCH_REQUESTS_MODEL-{args.model}{mini_suffix}.jsonl"
+        export_requests(batch_file, args.model, questions, indices, args.temperature, args.n)
+        print(f"Export {len(indices)} requests to {batch_file}")
+        sys.exit(0)
+    elif args.mode == "ingest":
+        assert args.batch_file, "--batch_file is required to ingest the results of a batch job"
+        batch_results = load_results(args.batch_file, args.model, args.n)
+        items = [(index, batch_results.get(index)) for index in indices]
+        answer = lambda item: ingest_answer(item[0], item[1], args, db_ids)
+    elif args.adaptive_sc:
+        items = [[index] for index in indices]
+        answer = lambda item: answer_adaptive(item, args, questions, db_ids)
+    else:
+        # pack as many prompts into each request as the token budget allows
+        items = pack_prompts(questions, indices, lambda prompt: estimate_tokens([prompt], args.n),
+                             max_tokens=args.batch_tokens, max_prompts=args.batch_size)
+        answer = None
+
+    journal.open(reset=not args.resume and args.start_index == 0)
+    metrics = init_metrics(out_file + ".metrics.jsonl", args.model)
+
+    # the result file is assembled from the journal at the end with --resume, or once the deferred vote is done
+    # a resumed run also votes on the questions an interrupted --exec_workers run left without a SQL
+    deferred_vote = args.exec_workers > 1 and args.n > 1 and not args.adaptive_sc or \
+                    any(record["sql"] is None for record in finished.values())
+    assemble = args.resume or deferred_vote
     token_cnt = 0
-    with open(out_file, mode) as f:
-        for i, batch in enumerate(tqdm(question_loader)):
-            if i < args.start_index:
-                continue
-            if i >= args.end_index:
-                break
-            try:
-                res = ask_llm(args.model, batch, args.temperature, args.n)
-            except openai.error.InvalidRequestError:
-                print(f"The {i}-th question has too much tokens! Return \"SELECT\" instead")
-                res = ""
-
-            # parse result
-            token_cnt += res["total_tokens"]
-            if args.n == 1:
-                for sql in res["response"]:
-                    # remove \n and extra spaces
-                    sql = " ".join(sql.replace("\n", " ").split())
-                    sql = process_duplication(sql)
-                    # python version should >= 3.8
-                    if sql.startswith("SELECT"):
-                        f.write(sql + "\n")
-                    elif sql.startswith(" "):
-                        f.write("SELECT" + sql + "\n")
-                    else:
-                        f.write("SELECT " + sql + "\n")
+    try:
+        with open(out_file if not assemble else os.devnull, mode) as f:
+            # requests run concurrently, but results come back (and are written) in question order
+            if answer is None:
+                # LLM requests and SQL execution for voting run in separate pools and overlap
+                results = ordered_pipeline(lambda item: generate_batch(item, args, questions),
+                                           lambda generated: vote_batch(*generated, args, db_ids),
+                                           items,
+                                           num_workers=args.num_workers,
+                                           num_second_workers=args.vote_workers)
             else:
-                results = []
-                cur_db_ids = db_ids[i * args.batch_size: i * args.batch_size + len(batch)]
-                for sqls, db_id in zip(res["response"], cur_db_ids):
-                    processed_sqls = []
-                    for sql in sqls:
-                        sql = " ".join(sql.replace("\n", " ").split())
-                        sql = process_duplication(sql)
-                        if sql.startswith("SELECT"):
-                            pass
-                        elif sql.startswith(" "):
-                            sql = "SELECT" + sql
-                        else:
-                            sql = "SELECT " + sql
-                        processed_sqls.append(sql)
-                    result = {
-                        'db_id': db_id,
-                        'p_sqls': processed_sqls
-                    }
-                    final_sqls = get_sqls([result], args.n, args.db_dir)
-
-                    for sql in final_sqls:
-                        f.write(sql + "\n")
+                results = ordered_map(answer, items, num_workers=args.num_workers)
+            progress = tqdm(results, total=len(items))
+            for records, n_tokens in progress:
+                token_cnt += n_tokens
+                for record in records:
+                    journal.append(record)
+                    if record["sql"] is not None:
+                        f.write(record["sql"] + "\n")
+                f.flush()
+                progress.set_postfix(tokens=token_cnt, cost=f"{metrics.get_cost():.2f}")
+    finally:
+        journal.close()
+        metrics.close()
+
+    if deferred_vote:
+        vote_deferred(journal, args)
+
+    summary = metrics.summary()
+    summary["token_cnt"] = token_cnt
+    summary["execution"] = get_exec_stats()
+    json.dump(summary, open(out_file + ".metrics_summary.json", "w"), indent=4)
+    print(f"Total {token_cnt} tokens ({summary['cached_tokens']} more served from the cache), "
+          f"estimated cost {summary['cost']:.2f}, "
+          f"{summary['tokens_per_second']:.1f} tokens/s, "
+          f"latency p50/p95/p99 {summary['latency_p50']:.2f}/{summary['latency_p95']:.2f}/{summary['latency_p99']:.2f}s, "
+          f"retries {summary['retries']}")
+    if summary["execution"]:
+        print(f"Executed {summary['execution'].get('executed', 0)} candidates, "
+              f"{summary['execution'].get('exception', 0)} failed, {summary['execution'].get('timeout', 0)} timed out, "
+              f"{summary['execution'].get('oversized', 0)} oversized, "
+              f"{summary['execution'].get('cached', 0)} taken from the execution cache")
+
+    if assemble:
+        records = journal.load()
+        tmp_file = out_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for index in sorted(records):
+                f.write(records[index]["sql"] + "\n")
+        os.replace(tmp_file, out_file)
+        print(f"Assemble {len(records)} questions from the journal into {out_file}")
 
+    if cache is not None:
+        stats = cache.get_stats()
+        print(f"LLM cache: {stats['hits']} hits, {stats['misses']} misses, hit rate {stats['hit_rate']:.2%}")
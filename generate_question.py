@@ -9,6 +9,7 @@ from prompt.prompt_builder import prompt_factory
 from utils.data_builder import load_data
 from utils.enums import REPR_TYPE, EXAMPLE_TYPE, SELECTOR_TYPE, LLM
 from utils.utils import cost_estimate
+from utils.vector_index import INDEX_TYPES
 
 from tqdm import tqdm
 
@@ -59,8 +60,16 @@ if __name__ == '__main__':
     parser.add_argument("--max_seq_len", type=int, default=2048, help="The maximal length that LLM takes")
     parser.add_argument("--max_ans_len", type=int, default=200, help="The maximal length that an answer takes")
     parser.add_argument("--tokenizer", type=str, default="gpt-3.5-turbo")
+    parser.add_argument("--tokenizer_path", type=str, default=None,
+                        help="Local .tiktoken file of the tokenizer's encoding, or a local transformers tokenizer directory")
     parser.add_argument("--scope_factor", type=int, default=100, help="Times of the searching scope")
     parser.add_argument("--pre_test_result", type=str, default=None)
+    parser.add_argument("--embedding_dir", type=str, default=None,
+                        help="Directory of the stored question embeddings of the selectors, dataset/embeddings by default")
+    parser.add_argument("--index_type", type=str, choices=INDEX_TYPES, default="exact",
+                        help="Nearest-neighbour search of the selectors, exact or an approximate IVF index")
+    parser.add_argument("--ivf_lists", type=int, default=None, help="Lists of the IVF index, 4 * sqrt(train size) by default")
+    parser.add_argument("--ivf_probe", type=int, default=8, help="Lists of the IVF index searched per question")
 
     args = parser.parse_args()
 
@@ -71,7 +80,10 @@ if __name__ == '__main__':
     databases = data.get_databases()
 
     # select the prompt
-    prompt = prompt_factory(args.prompt_repr, args.k_shot, args.example_type, args.selector_type)(data=data, tokenizer=args.tokenizer)
+    prompt_cls = prompt_factory(args.prompt_repr, args.k_shot, args.example_type, args.selector_type)
+    prompt = prompt_cls(data=data, tokenizer=args.tokenizer, tokenizer_path=args.tokenizer_path,
+                        embedding_dir=args.embedding_dir,
+                        index_type=args.index_type, ivf_lists=args.ivf_lists, ivf_probe=args.ivf_probe)
 
     # format all questions
     questions = list()
@@ -80,8 +92,13 @@ if __name__ == '__main__':
     # choose split
     func_name = f"get_{args.split}_json"
     cross_domain = args.split == "train"
+    targets = getattr(data, func_name)()
+
+    # encode all targets in one batch and find their closest examples before formatting
+    if args.k_shot > 0:
+        prompt.precompute_examples(targets, args.k_shot * args.scope_factor)
     
-    for question_json in tqdm(getattr(data, func_name)()):
+    for question_json in tqdm(targets):
         
         question_format = prompt.format(target=question_json,
                                         max_seq_len=args.max_seq_len,
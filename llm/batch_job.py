@@ -0,0 +1,51 @@
+import json
+
+from llm.chatgpt import completion_request, chat_request, parse_completion, parse_chat
+from utils.enums import LLM
+
+CUSTOM_ID_PREFIX = "question-"
+
+
+def export_requests(path: str, model: str, questions: list, indices: list, temperature: float, n: int):
+    """Write one request per question in the JSONL format of the OpenAI batch API."""
+    with open(path, "w") as f:
+        for index in indices:
+            if model in LLM.TASK_COMPLETIONS:
+                url = "/v1/completions"
+                body = completion_request(model, [questions[index]], temperature)
+            else:
+                url = "/v1/chat/completions"
+                messages = [{"role": "user", "content": questions[index]}]
+                body = chat_request(model, messages, temperature, n)
+            request = {
+                "custom_id": f"{CUSTOM_ID_PREFIX}{index}",
+                "method": "POST",
+                "url": url,
+                "body": body
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+
+def load_results(path: str, model: str, n: int):
+    """Read a result file of the OpenAI batch API.
+
+    Return a dict from question index to the response in the same format as ask_llm() with a batch of one question.
+    Failed requests are left out.
+    """
+    results = dict()
+    for line in open(path, "r"):
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        index = int(result["custom_id"][len(CUSTOM_ID_PREFIX):])
+        response = result.get("response") or dict()
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"The {index}-th question failed in the batch job: {result.get('error') or response.get('body')}")
+            continue
+        if model in LLM.TASK_COMPLETIONS:
+            results[index] = parse_completion(response["body"])
+        else:
+            res = parse_chat(response["body"], n)
+            res["response"] = [res["response"]]
+            results[index] = res
+    return results
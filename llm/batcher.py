@@ -0,0 +1,20 @@
+def pack_prompts(prompts: list, indices: list, count_tokens, max_tokens: int = 0, max_prompts: int = 1):
+    """Pack the prompts of the given question indices into batches for one request each.
+
+    Consecutive prompts are added to a batch until it would exceed max_tokens (as counted by count_tokens,
+    0 for no limit) or hold max_prompts prompts. A prompt larger than max_tokens gets a batch of its own.
+    Return a list of batches, each a list of question indices.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for index in indices:
+        n_tokens = count_tokens(prompts[index])
+        full = len(batch) >= max_prompts or max_tokens and batch_tokens + n_tokens > max_tokens
+        if batch and full:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(index)
+        batch_tokens += n_tokens
+    if batch:
+        batches.append(batch)
+    return batches
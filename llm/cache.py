@@ -0,0 +1,52 @@
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+class LLMCache(object):
+    """On-disk cache of LLM responses, keyed by a hash of everything that determines the request.
+
+    It is backed by SQLite so that it survives crashes, and is safe to share between the workers of a run.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(**request):
+        request_str = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request_str.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, response: dict):
+        response_str = json.dumps(response, ensure_ascii=False)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (key, response_str))
+            self.connection.commit()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
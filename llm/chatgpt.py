@@ -1,11 +1,26 @@
 import json.decoder
 
+import collections
+
 import openai
+from llm.cache import LLMCache
+from llm.metrics import MetricsRecorder
+from llm.rate_limiter import RateLimiter, backoff_delay, retry_after
 from utils.enums import LLM
 import time
 
+MAX_TOKENS = 200
+STOP = [";"]
+
+# shared by all workers of a run, unlimited until init_rate_limiter is called
+rate_limiter = RateLimiter()
+# disabled until init_cache is called
+response_cache = None
+# aggregated in memory only until init_metrics is called
+metrics = MetricsRecorder()
+
 
-def init_chatgpt(OPENAI_API_KEY, OPENAI_GROUP_ID, model):
+def init_chatgpt(OPENAI_API_KEY, OPENAI_GROUP_ID, model, OPENAI_API_BASE=None):
     # if model == LLM.TONG_YI_QIAN_WEN:
     #     import dashscope
     #     dashscope.api_key = OPENAI_API_KEY
@@ -14,34 +29,68 @@ def init_chatgpt(OPENAI_API_KEY, OPENAI_GROUP_ID, model):
     #     openai.organization = OPENAI_GROUP_ID
     openai.api_key = OPENAI_API_KEY
     openai.organization = OPENAI_GROUP_ID
+    # e.g. the local mock server in llm/mock_server.py
+    if OPENAI_API_BASE:
+        openai.api_base = OPENAI_API_BASE
 
 
-def ask_completion(model, batch, temperature):
-    response = openai.Completion.create(
+def init_rate_limiter(rpm: int = 0, tpm: int = 0):
+    global rate_limiter
+    rate_limiter = RateLimiter(rpm, tpm)
+
+
+def init_cache(path: str):
+    global response_cache
+    response_cache = LLMCache(path) if path else None
+    return response_cache
+
+
+def init_metrics(path: str, model: str):
+    global metrics
+    metrics = MetricsRecorder(path, model)
+    return metrics
+
+
+def estimate_tokens(batch: list, n: int):
+    # rough count before sending (~4 characters per token), plus the completion budget the provider reserves
+    prompt_tokens = sum(len(prompt) // 4 + 1 for prompt in batch)
+    return prompt_tokens + MAX_TOKENS * n * len(batch)
+
+
+def completion_request(model, batch, temperature):
+    return dict(
         model=model,
         prompt=batch,
         temperature=temperature,
-        max_tokens=200,
+        max_tokens=MAX_TOKENS,
         top_p=1,
         frequency_penalty=0,
         presence_penalty=0,
-        stop=[";"]
-    )
-    response_clean = [_["text"] for _ in response["choices"]]
-    return dict(
-        response=response_clean,
-        **response["usage"]
+        stop=STOP
     )
 
 
-def ask_chat(model, messages: list, temperature, n):
-    response = openai.ChatCompletion.create(
+def chat_request(model, messages: list, temperature, n):
+    return dict(
         model=model,
         messages=messages,
         temperature=temperature,
-        max_tokens=200,
+        max_tokens=MAX_TOKENS,
         n=n
     )
+
+
+def parse_completion(response):
+    # the index of a choice is the position of its prompt in the batch
+    choices = sorted(response["choices"], key=lambda choice: choice["index"])
+    response_clean = [_["text"] for _ in choices]
+    return dict(
+        response=response_clean,
+        **response["usage"]
+    )
+
+
+def parse_chat(response, n):
     response_clean = [choice["message"]["content"] for choice in response["choices"]]
     if n == 1:
         response_clean = response_clean[0]
@@ -51,9 +100,46 @@ def ask_chat(model, messages: list, temperature, n):
     )
 
 
-def ask_llm(model: str, batch: list, temperature: float, n:int):
+def ask_completion(model, batch, temperature):
+    response = openai.Completion.create(**completion_request(model, batch, temperature))
+    return parse_completion(response)
+
+
+def ask_chat(model, messages: list, temperature, n):
+    response = openai.ChatCompletion.create(**chat_request(model, messages, temperature, n))
+    return parse_chat(response, n)
+
+
+def ask_llm(model: str, batch: list, temperature: float, n:int, sample_round: int = 0):
+    # sample_round tells apart repeated requests for more samples of the same prompt
+    cache_key = None
+    if response_cache is not None:
+        request = dict(model=model,
+                       prompt=batch,
+                       temperature=temperature,
+                       n=n,
+                       max_tokens=MAX_TOKENS,
+                       stop=STOP if model in LLM.TASK_COMPLETIONS else None)
+        if sample_round:
+            request["sample_round"] = sample_round
+        cache_key = response_cache.make_key(**request)
+        response = response_cache.get(cache_key)
+        if response is not None:
+            # nothing was spent on a cached response, its tokens are only reported as cached_tokens
+            response["cached"] = True
+            response["cached_tokens"] = response.get("total_tokens", 0)
+            response["total_tokens"] = 0
+            metrics.record(model=model, n=n, batch_size=len(batch), latency=0., cached=True,
+                           cached_tokens=response["cached_tokens"])
+            return response
+
+    n_tokens = estimate_tokens(batch, n)
     n_repeat = 0
+    retries = collections.Counter()
+    start_time = time.monotonic()
     while True:
+        rate_limiter.acquire(n_tokens)
+        request_start_time = time.monotonic()
         try:
             if model in LLM.TASK_COMPLETIONS:
                 # TODO: self-consistency in this mode
@@ -66,21 +152,55 @@ def ask_llm(model: str, batch: list, temperature: float, n:int):
                 response = ask_chat(model, messages, temperature, n)
                 response['response'] = [response['response']]
             break
-        except openai.error.RateLimitError:
+        except (openai.error.InvalidRequestError, openai.error.AuthenticationError,
+                openai.error.PermissionError, AssertionError) as e:
+            # retrying can't fix these; a rejected request spent no tokens, only its request is still counted
+            rate_limiter.settle(n_tokens, 0)
+            metrics.record(model=model, n=n, batch_size=len(batch), latency=time.monotonic() - start_time,
+                           retries=retries, error=type(e).__name__)
+            raise
+        except openai.error.RateLimitError as e:
+            # failed attempts spent no tokens, give back their estimate and keep charging the request
+            rate_limiter.settle(n_tokens, 0)
             n_repeat += 1
-            print(f"Repeat for the {n_repeat} times for RateLimitError", end="\n")
-            time.sleep(1)
+            retries[type(e).__name__] += 1
+            delay = retry_after(e)
+            if delay is None:
+                delay = backoff_delay(n_repeat)
+            print(f"Repeat for the {n_repeat} times for RateLimitError, wait {delay:.1f}s", end="\n")
+            # every worker backs off, otherwise the others keep hitting the limit
+            rate_limiter.pause(delay)
             continue
-        except json.decoder.JSONDecodeError:
+        except json.decoder.JSONDecodeError as e:
+            rate_limiter.settle(n_tokens, 0)
             n_repeat += 1
-            print(f"Repeat for the {n_repeat} times for JSONDecodeError", end="\n")
-            time.sleep(1)
+            retries[type(e).__name__] += 1
+            delay = backoff_delay(n_repeat)
+            print(f"Repeat for the {n_repeat} times for JSONDecodeError, wait {delay:.1f}s", end="\n")
+            time.sleep(delay)
             continue
         except Exception as e:
+            rate_limiter.settle(n_tokens, 0)
             n_repeat += 1
-            print(f"Repeat for the {n_repeat} times for exception: {e}", end="\n")
-            time.sleep(1)
+            retries[type(e).__name__] += 1
+            delay = retry_after(e)
+            if delay is None:
+                delay = backoff_delay(n_repeat)
+            print(f"Repeat for the {n_repeat} times for exception: {e}, wait {delay:.1f}s", end="\n")
+            time.sleep(delay)
             continue
 
+    end_time = time.monotonic()
+    metrics.record(model=model,
+                   n=n,
+                   batch_size=len(batch),
+                   latency=end_time - start_time,
+                   request_latency=end_time - request_start_time,
+                   prompt_tokens=response.get("prompt_tokens", 0),
+                   completion_tokens=response.get("completion_tokens", 0),
+                   total_tokens=response.get("total_tokens", 0),
+                   retries=retries)
+    rate_limiter.settle(n_tokens, response.get("total_tokens", n_tokens))
+    if cache_key is not None:
+        response_cache.put(cache_key, response)
     return response
-
@@ -0,0 +1,76 @@
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, items, num_workers: int = 1, max_pending: int = None):
+    """Apply func to items with up to num_workers calls in flight, and yield the results in input order.
+
+    Finished results wait in a reorder buffer until all earlier items are done. At most max_pending
+    items (running or buffered) are outstanding at any time, so a slow item can't make the buffer grow unbounded.
+    """
+    if num_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if max_pending is None:
+        max_pending = 4 * num_workers
+    max_pending = max(max_pending, num_workers)
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            # the window is full, wait for the oldest item
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def ordered_pipeline(first, second, items, num_workers: int = 1, num_second_workers: int = 1,
+                     max_queue: int = None, max_pending: int = None):
+    """Run first and then second on every item in two separate thread pools, and yield the results in input order.
+
+    The stages overlap: while second runs on one item, first is already running on the next ones. At most
+    max_queue items wait for or run in second; a worker of first blocks when it is full, which holds back first
+    instead of buffering its results without bound.
+    """
+    num_workers = max(num_workers, 1)
+    num_second_workers = max(num_second_workers, 1)
+    if max_queue is None:
+        max_queue = 2 * num_second_workers
+    if max_pending is None:
+        max_pending = 4 * num_workers + max_queue
+    max_pending = max(max_pending, num_workers)
+
+    second_executor = ThreadPoolExecutor(max_workers=num_second_workers)
+    slots = threading.BoundedSemaphore(max_queue)
+
+    def run(item):
+        intermediate = first(item)
+        slots.acquire()
+        future = second_executor.submit(second, intermediate)
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(run, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result().result()
+        while pending:
+            yield pending.popleft().result().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        second_executor.shutdown(wait=True)
@@ -0,0 +1,78 @@
+import collections
+import json
+import threading
+import time
+
+from utils.enums import LLM
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return 0.
+    values = sorted(values)
+    rank = q / 100 * (len(values) - 1)
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class MetricsRecorder(object):
+    """Per-request telemetry of the LLM client: latency, tokens, retries by error class and n.
+
+    Every call is appended to a JSONL file (if a path is given) and aggregated in memory for the summary.
+    """
+    def __init__(self, path: str = None, model: str = None):
+        self.model = model
+        self.lock = threading.Lock()
+        self.file = open(path, "a") if path else None
+        self.start_time = time.time()
+        self.latencies = []
+        self.n_calls = 0
+        self.n_cached = 0
+        self.tokens = collections.Counter()
+        self.retries = collections.Counter()
+
+    def record(self, **metrics):
+        metrics["time"] = time.time()
+        with self.lock:
+            self.n_calls += 1
+            if metrics.get("cached"):
+                self.n_cached += 1
+                self.tokens["cached_tokens"] += metrics.get("cached_tokens", 0)
+            else:
+                self.latencies.append(metrics["latency"])
+                for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                    self.tokens[key] += metrics.get(key, 0)
+            self.retries.update(metrics.get("retries", dict()))
+            if self.file is not None:
+                self.file.write(json.dumps(metrics) + "\n")
+                self.file.flush()
+
+    def get_cost(self):
+        return LLM.costs_per_thousand.get(self.model, 0) * self.tokens["total_tokens"] / 1000
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            return {
+                "model": self.model,
+                "calls": self.n_calls,
+                "cached_calls": self.n_cached,
+                "latency_p50": percentile(self.latencies, 50),
+                "latency_p95": percentile(self.latencies, 95),
+                "latency_p99": percentile(self.latencies, 99),
+                "prompt_tokens": self.tokens["prompt_tokens"],
+                "completion_tokens": self.tokens["completion_tokens"],
+                "total_tokens": self.tokens["total_tokens"],
+                "cached_tokens": self.tokens["cached_tokens"],
+                "tokens_per_second": self.tokens["total_tokens"] / elapsed if elapsed > 0 else 0.,
+                "retries": dict(self.retries),
+                "cost": self.get_cost(),
+                "elapsed_seconds": elapsed
+            }
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
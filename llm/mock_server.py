@@ -0,0 +1,190 @@
+"""
+Local stand-in for the OpenAI Completion and ChatCompletion API, used to load-test ask_llm.py offline
+
+    python -m llm.mock_server --questions [prompt_dir]/questions.json --latency_mean 1.0 --rpm 600
+    python ask_llm.py --openai_api_base http://127.0.0.1:8000/v1 --openai_api_key mock --question [prompt_dir]
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_SQL = "count(*) FROM singer"
+
+
+def count_tokens(text: str):
+    return len(text) // 4 + 1
+
+
+class MockLLM(object):
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.request_times = collections.deque()
+        self.token_times = collections.deque()
+        self.stats = collections.Counter()
+
+        # answer with the gold SQL that generate_question.py saved next to each prompt
+        self.gold = dict()
+        if args.questions:
+            for question in json.load(open(args.questions, "r"))["questions"]:
+                self.gold[question["prompt"]] = question["response"]
+
+    def sample_latency(self):
+        mean, std = self.args.latency_mean, self.args.latency_std
+        with self.lock:
+            if self.args.latency == "constant":
+                latency = mean
+            elif self.args.latency == "uniform":
+                latency = self.random.uniform(max(mean - std, 0), mean + std)
+            elif self.args.latency == "exponential":
+                latency = self.random.expovariate(1 / mean) if mean > 0 else 0
+            elif mean > 0:
+                # lognormal with the given mean and standard deviation
+                sigma = math.sqrt(math.log(1 + (std / mean) ** 2))
+                latency = self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+            else:
+                latency = 0
+        return max(latency, 0)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def check_rate_limit(self, n_tokens):
+        """Return the seconds to wait if the request exceeds the quota of the last minute, else None."""
+        with self.lock:
+            now = time.monotonic()
+            for times in (self.request_times, self.token_times):
+                while times and now - times[0][0] >= 60:
+                    times.popleft()
+            if self.args.rpm and len(self.request_times) >= self.args.rpm:
+                return 60 - (now - self.request_times[0][0])
+            if self.args.tpm and sum(_[1] for _ in self.token_times) + n_tokens > self.args.tpm:
+                return 60 - (now - self.token_times[0][0]) if self.token_times else 1
+            self.request_times.append((now, 1))
+            self.token_times.append((now, n_tokens))
+            if self.random.random() < self.args.rate_limit_rate:
+                return 1
+        return None
+
+    def answer(self, prompt: str):
+        return self.gold.get(prompt, self.args.canned_sql)
+
+    def complete(self, path: str, body: dict):
+        n = body.get("n", 1)
+        max_tokens = body.get("max_tokens", 16)
+        if path.endswith("/chat/completions"):
+            prompts = [body["messages"][-1]["content"]]
+        else:
+            prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+
+        choices = []
+        prompt_tokens, completion_tokens = 0, 0
+        for i, prompt in enumerate(prompts):
+            prompt_tokens += count_tokens(prompt)
+            for j in range(n):
+                text = self.answer(prompt)
+                completion_tokens += count_tokens(text)
+                if path.endswith("/chat/completions"):
+                    choices.append({"index": len(choices),
+                                    "message": {"role": "assistant", "content": text},
+                                    "finish_reason": "stop"})
+                else:
+                    choices.append({"index": i * n + j, "text": text, "logprobs": None, "finish_reason": "stop"})
+        return {
+            "id": f"mock-{uuid.uuid4().hex}",
+            "object": "chat.completion" if path.endswith("/chat/completions") else "text_completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }, prompt_tokens + max_tokens * n * len(prompts)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    llm: MockLLM = None
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, error_type, headers=None):
+        self.llm.count(f"status_{status}")
+        self.send_json(status, {"error": {"message": message, "type": error_type, "param": None, "code": None}}, headers)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self.send_json(200, dict(self.llm.stats))
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+
+    def do_POST(self):
+        if not self.path.endswith("/completions"):
+            self.send_error_json(404, f"Unknown path {self.path}", "invalid_request_error")
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        self.llm.count("requests")
+
+        response, n_tokens = self.llm.complete(self.path, body)
+        wait = self.llm.check_rate_limit(n_tokens)
+        if wait is not None:
+            self.send_error_json(429, "Rate limit reached (mock)", "requests", {"Retry-After": f"{max(wait, 0):.3f}"})
+            return
+
+        time.sleep(self.llm.sample_latency())
+        if self.llm.random.random() < self.llm.args.error_rate:
+            self.send_error_json(500, "The server had an error while processing your request (mock)", "server_error")
+            return
+        self.llm.count("status_200")
+        self.llm.count("total_tokens", response["usage"]["total_tokens"])
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        if self.llm.args.verbose:
+            super().log_message(format, *args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--questions", type=str, default=None, help="questions.json to take the gold SQL from")
+    parser.add_argument("--canned_sql", type=str, default=DEFAULT_SQL, help="Answer for prompts without gold SQL")
+    parser.add_argument("--latency", type=str, choices=["constant", "uniform", "exponential", "lognormal"], default="constant")
+    parser.add_argument("--latency_mean", type=float, default=0.5, help="Mean latency in seconds")
+    parser.add_argument("--latency_std", type=float, default=0.2, help="Standard deviation of the latency, half width for uniform")
+    parser.add_argument("--rpm", type=int, default=0, help="Requests-per-minute quota, 0 for unlimited")
+    parser.add_argument("--tpm", type=int, default=0, help="Tokens-per-minute quota, 0 for unlimited")
+    parser.add_argument("--rate_limit_rate", type=float, default=0., help="Probability of an injected 429")
+    parser.add_argument("--error_rate", type=float, default=0., help="Probability of an injected 500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    MockHandler.llm = MockLLM(args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    print(f"Mock LLM server on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(MockHandler.llm.stats)))
@@ -0,0 +1,89 @@
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    """Client-side limiter for the requests-per-minute and tokens-per-minute quotas of the provider.
+
+    One instance is shared by all workers of a run. Both quotas are token buckets refilled continuously, and
+    we aim at a fraction (headroom) of the quota, so the rate stays just under it instead of oscillating around it.
+    A rate limit hint from the provider pauses every worker, not only the one that got it.
+    """
+    # seconds of quota that may be spent in a burst
+    BURST_SECONDS = 6
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, headroom: float = 0.95):
+        self.condition = threading.Condition()
+        self.paused_until = 0.
+        self.buckets = dict()
+        for name, per_minute in (("requests", rpm), ("tokens", tpm)):
+            if per_minute and per_minute > 0:
+                rate = per_minute * headroom / 60
+                capacity = max(rate * self.BURST_SECONDS, 1)
+                self.buckets[name] = {"rate": rate, "capacity": capacity, "level": capacity}
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for bucket in self.buckets.values():
+            bucket["level"] = min(bucket["capacity"], bucket["level"] + bucket["rate"] * elapsed)
+
+    def _wait_time(self, now, costs):
+        wait = max(self.paused_until - now, 0.)
+        for name, cost in costs.items():
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                continue
+            # a request larger than the whole bucket is let through once the bucket is full
+            need = min(cost, bucket["capacity"]) - bucket["level"]
+            if need > 0:
+                wait = max(wait, need / bucket["rate"])
+        return wait
+
+    def acquire(self, n_tokens: int = 0):
+        """Block until one request with n_tokens estimated tokens fits in the quota, then consume it."""
+        costs = {"requests": 1, "tokens": n_tokens}
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now, costs)
+                if wait <= 0:
+                    break
+                self.condition.wait(wait)
+            for name, cost in costs.items():
+                if name in self.buckets:
+                    self.buckets[name]["level"] -= cost
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token bucket once the real usage of a request is known."""
+        with self.condition:
+            if "tokens" in self.buckets:
+                bucket = self.buckets["tokens"]
+                bucket["level"] = min(bucket["capacity"], bucket["level"] + estimated_tokens - actual_tokens)
+                self.condition.notify_all()
+
+    def pause(self, seconds: float):
+        """Hold back all workers for the given seconds, e.g. after the provider asked us to retry later."""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def backoff_delay(n_repeat: int, base: float = 1., cap: float = 60.):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** (n_repeat - 1)))
+
+
+def retry_after(error):
+    """Return the retry-after hint (in seconds) of an API error, or None if the provider sent none."""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
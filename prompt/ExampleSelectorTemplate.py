@@ -1,410 +1,377 @@
 import numpy as np
+import os
 import random
 
+from utils.embedding_store import EmbeddingStore
+from utils.vector_index import ExactIndex, IVFIndex, top_k, recall_at_k
 from utils.utils import sql2skeleton, jaccard_similarity
 from utils.linking_utils.application import mask_question_with_schema_linking
 
 
 class BasicExampleSelector(object):
-    def __init__(self, data, *args, **kwargs):
+    SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
+    METRIC = "euclidean"
+
+    def __init__(self, data, *args, embedding_dir=None, index_type="exact", ivf_lists=None, ivf_probe=8, **kwargs):
         self.data = data
         self.train_json = self.data.get_train_json()
         self.db_ids = [d["db_id"] for d in self.train_json]
+        # the integer code of every train example's db_id, and the train indexes of every db by code
+        db_names, self.db_codes = np.unique(self.db_ids, return_inverse=True)
+        self.db_code_index = {db_id: code for code, db_id in enumerate(db_names)}
+        order = np.argsort(self.db_codes, kind="stable")
+        bounds = np.searchsorted(self.db_codes[order], np.arange(len(db_names) + 1))
+        self.db_indexes = [order[bounds[code]:bounds[code + 1]] for code in range(len(db_names))]
+        # db_id -> the mask and the indexes of the train examples of other dbs, see cross_domain_mask
+        self.cross_domain_masks = dict()
+        self.cross_domain_indexes_cache = dict()
         self.train_questions = self.data.get_train_questions()
-
+        # embeddings are shared by all datasets and runs, see encode
+        self.embedding_dir = embedding_dir or os.path.join(os.path.dirname(data.path_data), "embeddings")
+        self.embedding_store = None
+        self.bert_model = None
+        # nearest-neighbour index over the train embeddings, see get_index
+        self.index_type = index_type
+        self.ivf_lists = ivf_lists
+        self.ivf_probe = ivf_probe
+        self.index = None
+        # filled by precompute_examples, keyed by get_target_key
+        self.target_embeddings = dict()
+        self.top_candidates = dict()
+        # skeleton field -> (distinct skeletons, the position of each train example's skeleton among them)
+        self.skeleton_codes = dict()
+
+    def get_bert_model(self):
+        # only loaded when some text isn't in the embedding store yet
+        if self.bert_model is None:
+            from sentence_transformers import SentenceTransformer
+            self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
+        return self.bert_model
+
+    def encode(self, texts: list, save: bool = True):
+        if self.embedding_store is None or self.embedding_store.model_name != self.SELECT_MODEL:
+            self.embedding_store = EmbeddingStore(self.embedding_dir, self.SELECT_MODEL)
+        return self.embedding_store.encode(texts, lambda missing: self.get_bert_model().encode(missing), save=save)
+
+    def get_target_texts(self, targets: list):
+        # the selectors with a mask token compare questions with their schema mentions masked
+        if getattr(self, "mask_token", None) is not None:
+            return mask_question_with_schema_linking(targets, mask_tag=self.mask_token, value_tag=self.value_token)
+        return [target["question"] for target in targets]
+
+    @staticmethod
+    def get_target_key(target):
+        return target["db_id"], target["question"]
+
+    def compute_distances(self, target_embeddings):
+        """Distances (smaller is closer) between target embeddings and all train embeddings, in the selector's metric."""
+        if self.METRIC == "cosine":
+            from sklearn.metrics.pairwise import cosine_similarity
+            return -cosine_similarity(target_embeddings, self.train_embeddings)
+        from sklearn.metrics.pairwise import euclidean_distances
+        return euclidean_distances(target_embeddings, self.train_embeddings)
+
+    def get_index(self):
+        """The index searched by precompute_examples: exact, or an IVF index saved next to the embedding store."""
+        if self.index is None:
+            if self.index_type == "ivf":
+                name = self.SELECT_MODEL.replace("/", "__")
+                path = os.path.join(self.embedding_dir, f"{name}.{self.METRIC}.ivf.npz")
+                self.index = IVFIndex(self.train_embeddings, self.METRIC, n_lists=self.ivf_lists,
+                                      n_probe=self.ivf_probe, path=path)
+            else:
+                self.index = ExactIndex(self.train_embeddings, self.compute_distances)
+        return self.index
+
+    def precompute_examples(self, targets: list, num_candidates: int, recall_sample: int = 200):
+        """Encode all targets at once and keep the num_candidates closest train examples of each.
+
+        get_examples then starts from these candidates, and only falls back to the distances to the whole
+        train set for a target whose candidates run out. With an approximate index, its recall@num_candidates
+        against exact search is measured on recall_sample targets and printed.
+        """
+        if not hasattr(self, "train_embeddings") or not targets:
+            return
+        target_embeddings = np.asarray(self.encode(self.get_target_texts(targets)))
+        index = self.get_index()
+        indexes, distances = index.search(target_embeddings, num_candidates)
+        for i, target in enumerate(targets):
+            key = self.get_target_key(target)
+            self.target_embeddings[key] = target_embeddings[i]
+            # an approximate index may find fewer candidates than asked, padded with -1
+            found = indexes[i] >= 0
+            self.top_candidates[key] = (indexes[i][found], distances[i][found])
+
+        if not isinstance(index, ExactIndex):
+            sample = np.random.RandomState(0).permutation(len(targets))[:recall_sample]
+            exact_indexes, _ = ExactIndex(self.train_embeddings, self.compute_distances).search(
+                target_embeddings[sample], num_candidates)
+            recall = recall_at_k(indexes[sample], exact_indexes)
+            print(f"Recall@{indexes.shape[1]} of the {index.name} index against exact search: {recall:.4f} "
+                  f"on {len(sample)} targets")
+
+    def get_target_embedding(self, target):
+        embedding = self.target_embeddings.get(self.get_target_key(target))
+        if embedding is None:
+            embedding = self.encode(self.get_target_texts([target]), save=False)[0]
+        return embedding
+
+    def get_distances(self, target):
+        return self.compute_distances(self.get_target_embedding(target)[None])[0]
+
+    def rank_examples(self, target, num_example: int, mask=None):
+        """Return the indexes and distances of the num_example train examples closest to target (among mask)."""
+        top_candidates = self.top_candidates.get(self.get_target_key(target))
+        if top_candidates is not None:
+            candidates, distances = top_candidates
+            if mask is not None:
+                keep = mask[candidates]
+                candidates, distances = candidates[keep], distances[keep]
+            # the precomputed candidates are the closest ones, so they suffice unless the mask drops too many
+            if len(candidates) >= num_example or len(top_candidates[0]) == len(self.train_json):
+                return candidates[:num_example], distances[:num_example]
+        distances = self.get_distances(target)
+        candidates = top_k(distances, num_example, mask)
+        return candidates, distances[candidates]
+
+    def cross_domain_mask(self, db_id):
+        """Read-only mask of the train examples of other dbs than db_id, built once per db."""
+        mask = self.cross_domain_masks.get(db_id)
+        if mask is None:
+            mask = np.ones(len(self.db_codes), dtype=bool)
+            code = self.db_code_index.get(db_id)
+            # a db without train examples (e.g. a dev db) masks nothing
+            if code is not None:
+                mask[self.db_indexes[code]] = False
+            mask.setflags(write=False)
+            self.cross_domain_masks[db_id] = mask
+        return mask
+
+    def cross_domain_indexes(self, db_id):
+        """Sorted indexes of the train examples of other dbs than db_id, built once per db."""
+        indexes = self.cross_domain_indexes_cache.get(db_id)
+        if indexes is None:
+            indexes = np.flatnonzero(self.cross_domain_mask(db_id))
+            indexes.setflags(write=False)
+            self.cross_domain_indexes_cache[db_id] = indexes
+        return indexes
+
+    def skeleton_similarities(self, target, field: str):
+        """Jaccard similarity between the target's skeleton and that of every train example.
+
+        Many examples share a skeleton, so it is computed once per distinct skeleton.
+        """
+        if field not in self.skeleton_codes:
+            skeletons, codes = np.unique([example[field] for example in self.train_json], return_inverse=True)
+            self.skeleton_codes[field] = (skeletons, codes)
+        skeletons, codes = self.skeleton_codes[field]
+        similarities = np.array([jaccard_similarity(skeleton, target[field]) for skeleton in skeletons])
+        return similarities[codes]
+
+    def rank_examples_by_skeleton(self, target, num_example: int, field: str, cross_domain: bool, fill: bool = True):
+        """The closest examples whose skeleton similarity reaches the threshold, then (with fill) the closest others."""
+        mask = self.cross_domain_mask(target["db_id"]) if cross_domain else np.ones(len(self.train_json), dtype=bool)
+        # Skeleton similarity
+        similar = self.skeleton_similarities(target, field) >= self.threshold
+        indexes, _ = self.rank_examples(target, num_example, mask & similar)
+        if fill and len(indexes) < num_example:
+            others, _ = self.rank_examples(target, num_example - len(indexes), mask & ~similar)
+            indexes = np.concatenate([indexes, others])
+        return indexes
 
     def get_examples(self, question, num_example, cross_domain=False):
         pass
 
-    def domain_mask(self, candidates: list, db_id):
-        cross_domain_candidates = [candidates[i] for i in range(len(self.db_ids)) if self.db_ids[i] != db_id]
-        return cross_domain_candidates
+    def domain_mask(self, candidates, db_id):
+        """The candidates (one per train example) that belong to other dbs than db_id."""
+        return np.asarray(candidates)[self.cross_domain_indexes(db_id)]
 
-    def retrieve_index(self, indexes: list, db_id):
-        cross_domain_indexes = [i for i in range(len(self.db_ids)) if self.db_ids[i] != db_id]
-        retrieved_indexes = [cross_domain_indexes[i] for i in indexes]
-        return retrieved_indexes
+    def retrieve_index(self, indexes, db_id):
+        """Map positions among the cross-domain train examples back to train indexes."""
+        return self.cross_domain_indexes(db_id)[np.asarray(indexes, dtype=np.int64)]
 
 
 class RandomExampleSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
         random.seed(0)
 
     def get_examples(self, target, num_example, cross_domain=False):
         train_json = self.train_json
-        indexes = list(range(len(train_json)))
-        if cross_domain:
-            indexes = domain_mask(indexes, target["db_id"])
-        selected_indexes = random.sample(indexes, num_example)
+        n_candidates = len(self.cross_domain_indexes(target["db_id"])) if cross_domain else len(train_json)
+        selected_indexes = random.sample(range(n_candidates), num_example)
         if cross_domain:
-            selected_indexes = retrieve_index(selected_indexes, target["db_id"])
+            selected_indexes = self.retrieve_index(selected_indexes, target["db_id"])
         return [train_json[index] for index in selected_indexes]
 
 
 class CosineSimilarExampleSelector(BasicExampleSelector):
+    METRIC = "cosine"
+
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         # self.SELECT_MODEL = "sentence-transformers/bert-base-nli-mean-tokens"
 
-        from sentence_transformers import SentenceTransformer
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(self.train_questions)
+        self.train_embeddings = self.encode(self.train_questions)
+        self.train_question_array = np.array([d["question"] for d in self.train_json])
 
-        
     def get_examples(self, target, num_example, cross_domain=False):
-        target_embedding = self.bert_model.encode([target["question"]])
-        # target_embedding = self.bert_model.embed_text([target["question"]]).cpu().detach().numpy()
-
         # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import cosine_similarity
-        similarities = np.squeeze(cosine_similarity(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(similarity, index) for similarity, index in zip(similarities, range(len(similarities)))]
-
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0], reverse=True)
-        top_pairs = list()
-        for s, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            if train_json[index]["question"] == target["question"]:
-                continue
-            top_pairs.append((index, s))
-            if len(top_pairs) >= num_example:
-                break
+        mask = self.train_question_array != target["question"]
+        if cross_domain:
+            mask &= self.cross_domain_mask(target["db_id"])
+        indexes, _ = self.rank_examples(target, num_example, mask)
 
-        return [train_json[index] for (index, s) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistanceExampleSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
 
-        from sentence_transformers import SentenceTransformer
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(self.train_questions)
+        self.train_embeddings = self.encode(self.train_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_embedding = self.bert_model.encode([target["question"]])
-
         # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
-
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
+        mask = self.cross_domain_mask(target["db_id"]) if cross_domain else None
+        indexes, _ = self.rank_examples(target, num_example, mask)
 
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistanceThresholdExampleSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         # self.top_distances = list()
         self.threshold = 0.85
 
-        from sentence_transformers import SentenceTransformer
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(self.train_questions)
+        self.train_embeddings = self.encode(self.train_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_embedding = self.bert_model.encode([target["question"]])
-
         # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
-
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if (cross_domain and similar_db_id == target["db_id"]) or d > self.threshold:
-                continue
-            top_pairs.append((index, d))
-            # self.top_distances.append(d)
-            if len(top_pairs) >= num_example:
-                break
+        mask = self.cross_domain_mask(target["db_id"]) if cross_domain else None
+        indexes, distances = self.rank_examples(target, num_example, mask)
+        # the examples are closest first, so the ones within the threshold are a prefix
+        indexes = indexes[distances <= self.threshold]
+        # self.top_distances.extend(distances[distances <= self.threshold])
         # print("mean", np.mean(self.top_distances))    # 0.822
         # print("std", np.std(self.top_distances, ddof=1))  # 0.144
         # print("max", max(self.top_distances)) # 1.166
 
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistanceSkeletonSimilarThresholdSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         self.threshold = 0.85
         self.mask_token = "<mask>"  # the "<mask>" is the mask token of all-mpnet-base-v2
         self.value_token = "<unk>"  # the "<unk>" is the unknown token of all-mpnet-base-v2
 
-        from sentence_transformers import SentenceTransformer
         train_mask_questions = mask_question_with_schema_linking(self.train_json, mask_tag=self.mask_token, value_tag=self.value_token)
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(train_mask_questions)
+        self.train_embeddings = self.encode(train_mask_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_mask_question = mask_question_with_schema_linking([target], mask_tag=self.mask_token, value_tag=self.value_token)
-        target_embedding = self.bert_model.encode(target_mask_question)
+        # find the most similar question in train dataset, preferring the ones with a similar skeleton
+        indexes = self.rank_examples_by_skeleton(target, num_example, "query_skeleton", cross_domain)
 
-        # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
-
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            # Skeleton similarity
-            if jaccard_similarity(train_json[index]["query_skeleton"], target["query_skeleton"]) < self.threshold:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        if len(top_pairs) < num_example:
-            for d, index in pairs_sorted:
-                similar_db_id = train_json[index]["db_id"]
-                if cross_domain and similar_db_id == target["db_id"]:
-                    continue
-                # Skeleton similarity
-                if jaccard_similarity(train_json[index]["query_skeleton"], target["query_skeleton"]) >= self.threshold:
-                    continue
-                top_pairs.append((index, d))
-                if len(top_pairs) >= num_example:
-                    break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistanceQuestionMaskSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         self.mask_token = "<mask>"  # the "<mask>" is the mask token of all-mpnet-base-v2
         self.value_token = "<unk>" # the "<unk>" is the unknown token of all-mpnet-base-v2
 
-        from sentence_transformers import SentenceTransformer
         train_mask_questions = mask_question_with_schema_linking(self.train_json, mask_tag=self.mask_token, value_tag=self.value_token)
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(train_mask_questions)
+        self.train_embeddings = self.encode(train_mask_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_mask_question = mask_question_with_schema_linking([target], mask_tag=self.mask_token, value_tag=self.value_token)
-        target_embedding = self.bert_model.encode(target_mask_question)
-
         # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
+        mask = self.cross_domain_mask(target["db_id"]) if cross_domain else None
+        indexes, _ = self.rank_examples(target, num_example, mask)
 
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
     
     
 class EuclideanDistancePreSkeletonSimilarThresholdSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         self.threshold = 0.85
 
-        from sentence_transformers import SentenceTransformer
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(self.train_questions)
+        self.train_embeddings = self.encode(self.train_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_embedding = self.bert_model.encode([target["question"]])
-
-        # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
+        # find the most similar question in train dataset, preferring the ones with a similar skeleton
+        indexes = self.rank_examples_by_skeleton(target, num_example, "pre_skeleton", cross_domain)
 
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            # Skeleton similarity
-            if jaccard_similarity(train_json[index]["pre_skeleton"], target["pre_skeleton"]) < self.threshold:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        if len(top_pairs) < num_example:
-            for d, index in pairs_sorted:
-                similar_db_id = train_json[index]["db_id"]
-                if cross_domain and similar_db_id == target["db_id"]:
-                    continue
-                # Skeleton similarity
-                if jaccard_similarity(train_json[index]["pre_skeleton"], target["pre_skeleton"]) >= self.threshold:
-                    continue
-                top_pairs.append((index, d))
-                if len(top_pairs) >= num_example:
-                    break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistancePreSkeletonSimilarPlusSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
 
-        from sentence_transformers import SentenceTransformer
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(self.train_questions)
+        self.train_embeddings = self.encode(self.train_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_embedding = self.bert_model.encode([target["question"]])
-
         # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        train_json = self.train_json
-        for i in range(len(train_json)):
-            distances[i] -= jaccard_similarity(train_json[i]["pre_skeleton"], target["pre_skeleton"])
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        # (the skeleton bonus can lift any example, so this needs the distances to the whole train set)
+        scores = self.get_distances(target) - self.skeleton_similarities(target, "pre_skeleton")
+        mask = self.cross_domain_mask(target["db_id"]) if cross_domain else None
+        indexes = top_k(scores, num_example, mask)
+
+        return [self.train_json[index] for index in indexes]
     
 
 class EuclideanDistanceQuestionMaskPreSkeletonSimilarThresholdSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         self.mask_token = "<mask>"  # the "<mask>" is the mask token of all-mpnet-base-v2
         self.value_token = "<unk>"  # the "<unk>" is the unknown token of all-mpnet-base-v2
         self.threshold = 0.85
 
-        from sentence_transformers import SentenceTransformer
         train_mask_questions = mask_question_with_schema_linking(self.train_json, mask_tag=self.mask_token, value_tag=self.value_token)
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(train_mask_questions)
+        self.train_embeddings = self.encode(train_mask_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_mask_question = mask_question_with_schema_linking([target], mask_tag=self.mask_token, value_tag=self.value_token)
-        target_embedding = self.bert_model.encode(target_mask_question)
-
-        # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
+        # find the most similar question in train dataset, preferring the ones with a similar skeleton
+        indexes = self.rank_examples_by_skeleton(target, num_example, "pre_skeleton", cross_domain)
 
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            # Skeleton similarity
-            if jaccard_similarity(train_json[index]["pre_skeleton"], target["pre_skeleton"]) < self.threshold:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        if len(top_pairs) < num_example:
-            for d, index in pairs_sorted:
-                similar_db_id = train_json[index]["db_id"]
-                if cross_domain and similar_db_id == target["db_id"]:
-                    continue
-                # Skeleton similarity
-                if jaccard_similarity(train_json[index]["pre_skeleton"], target["pre_skeleton"]) >= self.threshold:
-                    continue
-                top_pairs.append((index, d))
-                if len(top_pairs) >= num_example:
-                    break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
 
 
 class EuclideanDistanceQuestionMaskPreSkeletonSimilarThresholdShiftSelector(BasicExampleSelector):
     def __init__(self, data, *args, **kwargs):
-        super().__init__(data)
+        super().__init__(data, *args, **kwargs)
 
         self.SELECT_MODEL = "sentence-transformers/all-mpnet-base-v2"
         self.mask_token = "<mask>"  # the "<mask>" is the mask token of all-mpnet-base-v2
         self.value_token = "<unk>"  # the "<unk>" is the unknown token of all-mpnet-base-v2
         self.threshold = 0.85
 
-        from sentence_transformers import SentenceTransformer
         train_mask_questions = mask_question_with_schema_linking(self.train_json, mask_tag=self.mask_token, value_tag=self.value_token)
-        self.bert_model = SentenceTransformer(self.SELECT_MODEL, device="cpu")
-        self.train_embeddings = self.bert_model.encode(train_mask_questions)
+        self.train_embeddings = self.encode(train_mask_questions)
 
     def get_examples(self, target, num_example, cross_domain=False):
-        target_mask_question = mask_question_with_schema_linking([target], mask_tag=self.mask_token, value_tag=self.value_token)
-        target_embedding = self.bert_model.encode(target_mask_question)
+        # find the most similar question in train dataset, only among the ones with a similar skeleton
+        indexes = self.rank_examples_by_skeleton(target, num_example, "pre_skeleton", cross_domain, fill=False)
 
-        # find the most similar question in train dataset
-        from sklearn.metrics.pairwise import euclidean_distances
-        distances = np.squeeze(euclidean_distances(target_embedding, self.train_embeddings)).tolist()
-        pairs = [(distance, index) for distance, index in zip(distances, range(len(distances)))]
-
-        train_json = self.train_json
-        pairs_sorted = sorted(pairs, key=lambda x: x[0])
-        top_pairs = list()
-        for d, index in pairs_sorted:
-            similar_db_id = train_json[index]["db_id"]
-            if cross_domain and similar_db_id == target["db_id"]:
-                continue
-            # Skeleton similarity
-            if jaccard_similarity(train_json[index]["pre_skeleton"], target["pre_skeleton"]) < self.threshold:
-                continue
-            top_pairs.append((index, d))
-            if len(top_pairs) >= num_example:
-                break
-
-        return [train_json[index] for (index, d) in top_pairs]
+        return [self.train_json[index] for index in indexes]
@@ -6,11 +6,20 @@ class BasicICLPrompt(object):
     NUM_EXAMPLE = None
     SEP_EXAMPLE = "\n\n"
 
-    def __init__(self, tokenizer: str, *args, **kwargs):
-        self.tokenizer = get_tokenizer(tokenizer)
+    def __init__(self, tokenizer: str, *args, tokenizer_path: str = None, **kwargs):
+        self.tokenizer = get_tokenizer(tokenizer, tokenizer_path)
+        # examples are shared by many targets, so each fragment is counted once
+        self.token_counts = dict()
         self.example_qualities = []
         self.pattern_similarities = []
 
+    def count_fragment_tokens(self, fragment: str):
+        n_tokens = self.token_counts.get(fragment)
+        if n_tokens is None:
+            n_tokens = count_tokens(fragment, tokenizer=self.tokenizer)
+            self.token_counts[fragment] = n_tokens
+        return n_tokens
+
     def record_example_quality(self, examples, target):
         quality_list = []
         for example in examples:
@@ -44,7 +53,8 @@ class BasicICLPrompt(object):
     def format(self, target: dict, max_seq_len: int, max_ans_len: int, scope_factor: int, cross_domain=False, *args, **kwargs):
         # target question
         prompt_target = self.format_target(target)
-        sum_tokens = count_tokens(prompt_target, tokenizer=self.tokenizer)
+        target_tokens = self.count_fragment_tokens(prompt_target)
+        sum_tokens = target_tokens
         
         if self.NUM_EXAMPLE != 0:
             # example questions
@@ -52,6 +62,11 @@ class BasicICLPrompt(object):
             prompt_example = list()
             question = target["question"]
             example_prefix = self.get_example_prefix()
+            # the prompt is the prefix plus the examples and the target joined by separators,
+            # so its tokens are summed per fragment instead of re-counting the whole prompt for every example
+            prefix_tokens = self.count_fragment_tokens(example_prefix)
+            sep_tokens = self.count_fragment_tokens(self.SEP_EXAMPLE)
+            example_tokens = 0
             selected_examples = []
             for example in examples:
                 example_question = example["question"]
@@ -62,12 +77,14 @@ class BasicICLPrompt(object):
                 example_format = self.format_example(example)
                 
                 # count tokens and drop the example if exceed max_len
-                forward_tokens = count_tokens(example_prefix + self.SEP_EXAMPLE.join(prompt_example + [example_format, prompt_target]), tokenizer=self.tokenizer)
+                new_example_tokens = example_tokens + self.count_fragment_tokens(example_format)
+                forward_tokens = prefix_tokens + new_example_tokens + target_tokens + sep_tokens * (len(prompt_example) + 1)
                 
                 if forward_tokens + max_ans_len <= max_seq_len:
                     # add an example
                     prompt_example.append(example_format)
                     # update tokens
+                    example_tokens = new_example_tokens
                     sum_tokens = forward_tokens
                     # record the selected examples
                     selected_examples.append(example)
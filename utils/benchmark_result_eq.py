@@ -0,0 +1,93 @@
+import argparse
+import random
+import time
+from typing import List, Tuple
+
+from utils.post_process import get_constraint_permutation, multiset_eq, permute_tuple, quick_rej, result_eq
+
+
+# result_eq before column signatures, kept as the baseline of the benchmark
+def baseline_result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -> bool:
+    if len(result1) == 0 and len(result2) == 0:
+        return True
+    if len(result1) != len(result2):
+        return False
+    num_cols = len(result1[0])
+    if len(result2[0]) != num_cols:
+        return False
+    if not quick_rej(result1, result2, order_matters):
+        return False
+    tab1_sets_by_columns = [{row[i] for row in result1} for i in range(num_cols)]
+    for perm in get_constraint_permutation(tab1_sets_by_columns, result2):
+        if len(perm) != len(set(perm)):
+            continue
+        if num_cols == 1:
+            result2_perm = result2
+        else:
+            result2_perm = [permute_tuple(element, perm) for element in result2]
+        if order_matters:
+            if result1 == result2_perm:
+                return True
+        else:
+            if set(result1) == set(result2_perm) and multiset_eq(result1, result2_perm):
+                return True
+    return False
+
+
+def make_table(n_rows: int, n_cols: int, n_values: int, rng: random.Random):
+    return [tuple(rng.randrange(n_values) for _ in range(n_cols)) for _ in range(n_rows)]
+
+
+def shuffle_table(table, rng: random.Random):
+    # the same denotation with its rows and columns shuffled
+    perm = list(range(len(table[0])))
+    rng.shuffle(perm)
+    shuffled = [permute_tuple(row, perm) for row in table]
+    rng.shuffle(shuffled)
+    return shuffled
+
+
+def make_cases(n_rows: int, n_cols: int, n_values: int, n_cases: int, seed: int):
+    """Pairs that pass quick_rej: equivalent ones, and ones that only differ in which values share a row."""
+    rng = random.Random(seed)
+    cases = []
+    for _ in range(n_cases):
+        table = make_table(n_rows, n_cols, n_values, rng)
+        cases.append((table, shuffle_table(table, rng)))
+        # swapping two values inside a row keeps every unordered row, but not the columns
+        broken = list(table)
+        row = list(broken[0])
+        row[0], row[-1] = row[-1], row[0]
+        broken[0] = tuple(row)
+        cases.append((table, shuffle_table(broken, rng)))
+    return cases
+
+
+def run(func, cases, repeat: int):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        outputs = [func(result1, result2, False) for result1, result2 in cases]
+    return (time.perf_counter() - start_time) / repeat, outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare result_eq with the baseline implementation")
+    parser.add_argument("--cases", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    shapes = [
+        # (name, rows, columns, distinct values)
+        ("narrow", 100, 3, 50),
+        ("tall", 50000, 3, 1000),
+        ("wide", 200, 7, 4),
+        ("wide, few values", 50, 6, 2),
+    ]
+    for name, n_rows, n_cols, n_values in shapes:
+        cases = make_cases(n_rows, n_cols, n_values, args.cases, args.seed)
+        baseline_time, baseline_outputs = run(baseline_result_eq, cases, args.repeat)
+        new_time, new_outputs = run(result_eq, cases, args.repeat)
+        assert baseline_outputs == new_outputs, f"result_eq disagrees with the baseline on {name} tables"
+        print(f"{name:>16} {n_rows:>7}x{n_cols:<3} baseline {baseline_time * 1000:10.1f}ms  "
+              f"result_eq {new_time * 1000:10.1f}ms  speedup {baseline_time / max(new_time, 1e-9):7.1f}x")
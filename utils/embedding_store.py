@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class EmbeddingStore(object):
+    """On-disk store of the sentence embeddings of one model, keyed by a hash of the text.
+
+    The embeddings are saved as one .npy matrix, memory-mapped when loaded, with the key of every row in a JSON
+    file next to it. Only texts that are not in the store yet are encoded.
+    """
+    def __init__(self, path_dir: str, model_name: str):
+        self.model_name = model_name
+        name = model_name.replace("/", "__")
+        self.path_vectors = os.path.join(path_dir, f"{name}.npy")
+        self.path_keys = os.path.join(path_dir, f"{name}.keys.json")
+        self.vectors = None
+        self.keys = []
+        # embeddings encoded in this run but not saved yet
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.index = dict()
+        self.load()
+
+    @staticmethod
+    def make_key(text: str):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not (os.path.exists(self.path_vectors) and os.path.exists(self.path_keys)):
+            return
+        keys = json.load(open(self.path_keys, "r"))
+        vectors = np.load(self.path_vectors, mmap_mode="r")
+        # the keys are written after the vectors, so a crash in between leaves them out of step
+        if len(keys) != len(vectors):
+            print(f"Ignore the embedding store {self.path_vectors}: {len(keys)} keys for {len(vectors)} embeddings")
+            return
+        self.keys = keys
+        self.vectors = vectors
+        self.index = {key: i for i, key in enumerate(keys)}
+
+    def encode(self, texts: list, encode_fn, save: bool = True):
+        """Return the embeddings of texts as a matrix, encoding the missing ones with encode_fn(list_of_texts).
+
+        With save=False the new embeddings are only kept in memory until the next save.
+        """
+        keys = [self.make_key(text) for text in texts]
+        missing = dict()
+        for key, text in zip(keys, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        if missing:
+            new_vectors = np.asarray(encode_fn(list(missing.values())))
+            for key, vector in zip(missing, new_vectors):
+                self.index[key] = len(self.keys) + len(self.pending_keys)
+                self.pending_keys.append(key)
+                self.pending_vectors.append(vector)
+            if save:
+                self.save()
+
+        rows = [self.index[key] for key in keys]
+        # the usual case at start-up: the whole store in its saved order, served straight from the memory map
+        if self.vectors is not None and rows == list(range(len(self.vectors))):
+            return self.vectors
+        n_saved = len(self.keys)
+        dim = self.vectors.shape[1] if self.vectors is not None else len(self.pending_vectors[0])
+        dtype = self.vectors.dtype if self.vectors is not None else self.pending_vectors[0].dtype
+        embeddings = np.empty((len(rows), dim), dtype=dtype)
+        rows = np.asarray(rows, dtype=np.int64)
+        saved = rows < n_saved
+        if saved.any():
+            embeddings[saved] = self.vectors[rows[saved]]
+        for i in np.flatnonzero(~saved):
+            embeddings[i] = self.pending_vectors[rows[i] - n_saved]
+        return embeddings
+
+    def save(self):
+        if not self.pending_keys:
+            return
+        os.makedirs(os.path.dirname(self.path_vectors) or ".", exist_ok=True)
+        pending = np.stack(self.pending_vectors)
+        vectors = pending if self.vectors is None else np.concatenate([self.vectors, pending.astype(self.vectors.dtype)])
+        keys = self.keys + self.pending_keys
+        # write to temporary files and swap them in, so a crash never leaves a half-written store
+        tmp_vectors = self.path_vectors + ".tmp.npy"
+        np.save(tmp_vectors, vectors)
+        os.replace(tmp_vectors, self.path_vectors)
+        tmp_keys = self.path_keys + ".tmp"
+        with open(tmp_keys, "w") as f:
+            json.dump(keys, f)
+        os.replace(tmp_keys, self.path_keys)
+        self.pending_keys = []
+        self.pending_vectors = []
+        self.vectors = np.load(self.path_vectors, mmap_mode="r")
+        self.keys = keys
@@ -0,0 +1,74 @@
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+
+
+# the content hash of a database file, recomputed only when the file changes
+@functools.lru_cache(maxsize=None)
+def file_digest(path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_db_hash(path: str) -> str:
+    stat = os.stat(path)
+    return file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class ExecCache(object):
+    """On-disk cache of SQL execution results, keyed by the content hash of the database file and the SQL.
+
+    Each entry holds the flag, the denotation fingerprint and the denotation or error of one execution.
+    Like LLMCache it is backed by SQLite, so several runs and worker processes can share it.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS executions (db_hash TEXT NOT NULL, sql TEXT NOT NULL, "
+                                "flag TEXT NOT NULL, fingerprint TEXT, value BLOB NOT NULL, PRIMARY KEY (db_hash, sql))")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db_hash: str, sql: str):
+        """Return (flag, denotation or error, fingerprint), or None if this SQL wasn't executed on the database yet."""
+        with self.lock:
+            row = self.connection.execute("SELECT flag, value, fingerprint FROM executions WHERE db_hash = ? AND sql = ?",
+                                          (db_hash, sql)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        flag, value, fingerprint = row
+        return flag, pickle.loads(value), fingerprint
+
+    def put(self, db_hash: str, sql: str, flag: str, value, fingerprint: str = None):
+        try:
+            value_blob = pickle.dumps(value)
+        except Exception:
+            # some exceptions can't be pickled, their message is enough
+            value_blob = pickle.dumps(Exception(repr(value)))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO executions (db_hash, sql, flag, fingerprint, value) "
+                                    "VALUES (?, ?, ?, ?, ?)", (db_hash, sql, flag, fingerprint, value_blob))
+            self.connection.commit()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+
+class Journal(object):
+    """Append-only JSONL record of finished questions, used to resume an interrupted run exactly.
+
+    Every line is one question: its index, raw responses and final SQL. Lines are flushed when written and
+    fsync-ed in batches (every fsync_every records or fsync_interval seconds). A torn last line left by a crash
+    is ignored when loading and cut off before appending again.
+    """
+    def __init__(self, path: str, fsync_every: int = 16, fsync_interval: float = 5.):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self.n_unsynced = 0
+        self.last_sync = time.monotonic()
+        self.valid_size = 0
+
+    def load(self):
+        """Return the finished records as a dict from question index to record."""
+        records = dict()
+        self.valid_size = 0
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                records[record["index"]] = record
+                self.valid_size += len(line)
+        return records
+
+    def open(self, reset: bool = False):
+        if reset:
+            self.file = open(self.path, "w")
+        else:
+            self.load()
+            self.file = open(self.path, "a")
+            # drop whatever follows the last complete record
+            self.file.truncate(self.valid_size)
+        return self
+
+    def append(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.n_unsynced += 1
+        if self.n_unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.file is None or self.n_unsynced == 0:
+            return
+        os.fsync(self.file.fileno())
+        self.n_unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -1,26 +1,116 @@
 import asyncio
+import functools
+import hashlib
 import json
 import os
 import random
 import re
 import sqlite3
 import threading
-from collections import defaultdict
-from itertools import product
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import defaultdict, Counter, OrderedDict
+from pathlib import Path
+from itertools import permutations, product
+from operator import itemgetter
 from typing import Tuple, Any, List, Set
 import sqlparse
 import tqdm
 
+from utils.exec_cache import ExecCache, get_db_hash
+
 
 # process the case of duplicated output of ChatGPT and GPT4 for SQL Representation with QA or SQLONLY Organization
 def process_duplication(sql):
     sql = sql.strip().split("/*")[0]
     return sql
 
+
+# turn a raw LLM response into a single-line SQL query starting with SELECT
+def clean_sql(sql):
+    # remove \n and extra spaces
+    sql = " ".join(sql.replace("\n", " ").split())
+    sql = process_duplication(sql)
+    if sql.startswith("SELECT"):
+        return sql
+    elif sql.startswith(" "):
+        return "SELECT" + sql
+    else:
+        return "SELECT " + sql
+
 threadLock = threading.Lock()
 TIMEOUT = 60
 EXEC_TMP_DIR = os.path.join(os.path.dirname(__file__), "tmp")
 
+# settings of candidate execution, change them with configure_execution before executing anything
+EXEC_CONFIG = {
+    # read-only connections kept open per thread
+    "pool_size": 32,
+    # bytes of each database file to memory-map, 0 to turn it off
+    "mmap_size": 0,
+    # bytes of databases each thread keeps as in-memory snapshots, 0 to always read from disk
+    "snapshot_bytes": 0,
+    # seconds a candidate may run before it is interrupted, 0 for no limit
+    "timeout": TIMEOUT,
+    # SQLite VM instructions a candidate may run before it is interrupted, 0 for no limit
+    "max_instructions": 0,
+    # rows of a result kept before it is truncated and marked as oversized, 0 for no limit
+    "max_rows": 100000,
+    # approximate bytes of a result kept before it is truncated and marked as oversized, 0 for no limit
+    "max_bytes": 64 << 20,
+    # ExecCache file shared by runs and worker processes, None to always execute
+    "cache_path": None,
+}
+# how many SQLite VM instructions run between two checks of the budget
+PROGRESS_INTERVAL = 1000
+# rows fetched from the cursor at a time
+FETCH_SIZE = 1000
+exec_local = threading.local()
+# executed candidates by outcome, see get_exec_stats
+exec_stats = Counter()
+# opened lazily in every process, see get_exec_cache
+exec_cache = None
+exec_cache_pid = None
+
+
+class ExecutionTimeout(TimeoutError):
+    """A candidate was interrupted because it ran past its time or instruction budget."""
+
+
+class TruncatedResult(list):
+    """The first rows of a result that exceeded the row or byte cap, and how many rows it had in total."""
+    def __init__(self, rows: List[Tuple], total_rows: int):
+        super().__init__(rows)
+        self.total_rows = total_rows
+
+
+def configure_execution(**config):
+    for key, value in config.items():
+        if key not in EXEC_CONFIG:
+            raise KeyError(f"Unknown execution setting {key}")
+        if key == "pool_size" and value is not None and value < 1:
+            raise ValueError(f"The connection pool must hold at least 1 connection, got {value}")
+        if value is not None:
+            EXEC_CONFIG[key] = value
+
+
+def get_exec_stats():
+    with threadLock:
+        return dict(exec_stats)
+
+
+def get_exec_cache():
+    global exec_cache, exec_cache_pid
+    path = EXEC_CONFIG["cache_path"]
+    if not path:
+        return None
+    with threadLock:
+        # a connection inherited from the parent process must not be used
+        if exec_cache is None or exec_cache_pid != os.getpid() or exec_cache.path != path:
+            exec_cache = ExecCache(path)
+            exec_cache_pid = os.getpid()
+        return exec_cache
+
 
 def permute_tuple(element: Tuple, perm: Tuple) -> Tuple:
     assert len(element) == len(perm)
@@ -75,6 +165,34 @@ def get_constraint_permutation(tab1_sets_by_columns: List[Set], result2: List[Tu
     return product(*perm_constraints)
 
 
+# the bag of values of every column, columns of two equivalent denotations must have equal ones
+def column_signatures(result: List[Tuple], num_cols: int) -> List[frozenset]:
+    return [frozenset(Counter(row[i] for row in result).items()) for i in range(num_cols)]
+
+
+# the column permutations that map columns of result2 to columns of result1 with the same signature
+def get_signature_permutation(result1: List[Tuple], result2: List[Tuple], num_cols: int):
+    signatures1 = column_signatures(result1, num_cols)
+    signatures2 = column_signatures(result2, num_cols)
+    columns1_by_signature = defaultdict(list)
+    columns2_by_signature = defaultdict(list)
+    for i in range(num_cols):
+        columns1_by_signature[signatures1[i]].append(i)
+        columns2_by_signature[signatures2[i]].append(i)
+    if any(len(columns2_by_signature.get(signature, [])) != len(columns1)
+           for signature, columns1 in columns1_by_signature.items()):
+        return
+
+    # only columns with the same signature can be swapped, so enumerate the permutations within each group
+    groups = list(columns1_by_signature.items())
+    for assignment in product(*[permutations(columns2_by_signature[signature]) for signature, _ in groups]):
+        perm = [0] * num_cols
+        for (_, columns1), columns2 in zip(groups, assignment):
+            for i, j in zip(columns1, columns2):
+                perm[i] = j
+        yield perm
+
+
 # check whether two denotations are correct
 def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -> bool:
     if len(result1) == 0 and len(result2) == 0:
@@ -90,40 +208,135 @@ def result_eq(result1: List[Tuple], result2: List[Tuple], order_matters: bool) -
     if len(result2[0]) != num_cols:
         return False
 
-    # unorder each row and compare whether the denotation is the same
-    # this can already find most pair of denotations that are different
-    if not quick_rej(result1, result2, order_matters):
-        return False
-
-    # the rest of the problem is in fact more complicated than one might think
     # we want to find a permutation of column order and a permutation of row order,
     # s.t. result_1 is the same as result_2
     # we return true if we can find such column & row permutations
     # and false if we cannot
-    tab1_sets_by_columns = [{row[i] for row in result1} for i in range(num_cols)]
-
-    # on a high level, we enumerate all possible column permutations that might make result_1 == result_2
-    # we decrease the size of the column permutation space by the function get_constraint_permutation
-    # if one of the permutation make result_1, result_2 equivalent, then they are equivalent
-    for perm in get_constraint_permutation(tab1_sets_by_columns, result2):
-        if len(perm) != len(set(perm)):
-            continue
-        if num_cols == 1:
-            result2_perm = result2
+    # (quick_rej is not needed anymore, it only holds when such permutations exist, and checking the
+    # few permutations allowed by the column signatures costs about the same as sorting every row)
+    row_counts1 = None if order_matters else Counter(result1)
+
+    # a column can only be mapped to a column with the same bag of values,
+    # which usually leaves a single permutation to check
+    for perm in get_signature_permutation(result1, result2, num_cols):
+        if perm == list(range(num_cols)):
+            permute = None
         else:
-            result2_perm = [permute_tuple(element, perm) for element in result2]
+            # itemgetter returns a value instead of a tuple for a single column, but then perm is the identity
+            permute = itemgetter(*perm)
+        rows2 = result2 if permute is None else map(permute, result2)
         if order_matters:
-            if result1 == result2_perm:
+            if all(row1 == row2 for row1, row2 in zip(result1, rows2)):
                 return True
         else:
-            # in fact the first condition must hold if the second condition holds
-            # but the first is way more efficient implementation-wise
-            # and we use it to quickly reject impossible candidates
-            if set(result1) == set(result2_perm) and multiset_eq(result1, result2_perm):
+            # count the permuted rows down against result1 instead of building a permuted copy
+            remaining = row_counts1.copy()
+            for row2 in rows2:
+                if remaining[row2] <= 0:
+                    break
+                remaining[row2] -= 1
+            else:
                 return True
     return False
 
 
+def canonical_value(value) -> str:
+    # values that are equal in Python get the same encoding, e.g. 1 and 1.0
+    if value is None:
+        return "z"
+    if isinstance(value, (bool, int)):
+        return "n" + str(int(value))
+    if isinstance(value, float):
+        if value.is_integer():
+            return "n" + str(int(value))
+        return "n" + repr(value)
+    if isinstance(value, bytes):
+        return "b" + value.hex()
+    # repr escapes the separator used in denotation_fingerprint
+    return "s" + repr(value)
+
+
+def multiset_digest(values) -> bytes:
+    return hashlib.blake2b("\x00".join(sorted(values)).encode(), digest_size=16).digest()
+
+
+# a hash of the denotation that ignores the order of its rows and columns
+# [result_1 and result_2 are equivalent in denotation]
+# implies
+# [result_1 and result_2 have the same fingerprint]
+# so only denotations with the same fingerprint have to be compared with result_eq
+def denotation_fingerprint(denotation: List[Tuple]) -> str:
+    # result_eq treats all empty denotations as equivalent, whatever their columns
+    if len(denotation) == 0:
+        return "empty"
+    # an oversized result is identified by the rows that were kept and its total size
+    if isinstance(denotation, TruncatedResult):
+        return f"oversized-{denotation.total_rows}-" + denotation_fingerprint(list(denotation))
+    num_cols = len(denotation[0])
+    rows = [[canonical_value(value) for value in row] for row in denotation]
+    # the bag of unordered rows, as in quick_rej
+    row_digests = sorted(multiset_digest(row) for row in rows)
+    # the bag of values of every column, in no particular column order
+    column_digests = sorted(multiset_digest(row[i] for row in rows) for i in range(num_cols))
+    fingerprint = hashlib.blake2b(f"{len(rows)}x{num_cols}".encode(), digest_size=16)
+    for digest in row_digests + column_digests:
+        fingerprint.update(digest)
+    return fingerprint.hexdigest()
+
+
+# result_eq, but oversized results are only equivalent to each other,
+# when they have the same number of rows and their kept rows are equivalent
+def denotation_eq(denotation1: List[Tuple], denotation2: List[Tuple]) -> bool:
+    truncated1 = isinstance(denotation1, TruncatedResult)
+    truncated2 = isinstance(denotation2, TruncatedResult)
+    if truncated1 or truncated2:
+        if not (truncated1 and truncated2) or denotation1.total_rows != denotation2.total_rows:
+            return False
+    return result_eq(denotation1, denotation2, False)
+
+
+def row_bytes(row: Tuple) -> int:
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+
+
+def fetch_result(cursor: sqlite3.Cursor, max_rows: int, max_bytes: int):
+    # rows past the caps are only counted, so a result takes bounded memory however large it is
+    result = []
+    n_bytes = 0
+    total_rows = 0
+    oversized = False
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        total_rows += len(rows)
+        if oversized:
+            continue
+        for row in rows:
+            size = row_bytes(row)
+            if max_rows and len(result) >= max_rows or max_bytes and n_bytes + size > max_bytes:
+                oversized = True
+                break
+            result.append(row)
+            n_bytes += size
+    if oversized:
+        return TruncatedResult(result, total_rows)
+    return result
+
+
+def cap_result(result: List[Tuple], max_rows: int, max_bytes: int):
+    # a complete result, e.g. from the execution cache, cut at the caps of this run as fetch_result would have
+    kept = []
+    n_bytes = 0
+    for row in result:
+        size = row_bytes(row)
+        if max_rows and len(kept) >= max_rows or max_bytes and n_bytes + size > max_bytes:
+            return TruncatedResult(kept, len(result))
+        kept.append(row)
+        n_bytes += size
+    return result
+
+
 def replace_cur_year(query: str) -> str:
     return re.sub(
         "YEAR\s*\(\s*CURDATE\s*\(\s*\)\s*\)\s*", "2020", query, flags=re.IGNORECASE
@@ -144,28 +357,127 @@ def get_cursor_from_path(sqlite_path: str):
     return cursor
 
 
-async def exec_on_db_(sqlite_path: str, query: str) -> Tuple[str, Any]:
+class ConnectionPool(object):
+    """LRU pool of read-only SQLite connections keyed by database path.
+
+    Voting executes many candidates on the same few databases, so connections are kept open instead of
+    being opened and closed for every candidate. With a snapshot_bytes budget, databases are copied into memory
+    with the backup API when they are first used, and the least recently used snapshots are dropped once their
+    total size exceeds the budget; a database larger than the whole budget is always read from disk.
+    A pool must only be used by one thread, see get_connection_pool.
+    """
+    def __init__(self, max_size: int, mmap_size: int = 0, snapshot_bytes: int = 0):
+        self.max_size = max_size
+        self.mmap_size = mmap_size
+        self.snapshot_bytes = snapshot_bytes
+        self.connections = OrderedDict()
+        # database path -> bytes of its in-memory snapshot
+        self.snapshot_sizes = dict()
+
+    def get(self, sqlite_path: str) -> sqlite3.Connection:
+        connection = self.connections.get(sqlite_path)
+        if connection is not None:
+            self.connections.move_to_end(sqlite_path)
+            return connection
+
+        size = os.path.getsize(sqlite_path) if self.snapshot_bytes else 0
+        if self.snapshot_bytes and size <= self.snapshot_bytes:
+            connection = self.load_snapshot(sqlite_path)
+            self.snapshot_sizes[sqlite_path] = size
+        else:
+            connection = sqlite3.connect(Path(sqlite_path).resolve().as_uri() + "?mode=ro", uri=True)
+            if self.mmap_size:
+                connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        connection.text_factory = lambda b: b.decode(errors="ignore")
+        self.connections[sqlite_path] = connection
+        # the connection just opened is never evicted, it is about to be used
+        while len(self.connections) > max(self.max_size, 1) or sum(self.snapshot_sizes.values()) > self.snapshot_bytes:
+            self.evict()
+        return connection
+
+    @staticmethod
+    def load_snapshot(sqlite_path: str) -> sqlite3.Connection:
+        source = sqlite3.connect(Path(sqlite_path).resolve().as_uri() + "?mode=ro", uri=True)
+        snapshot = sqlite3.connect(":memory:")
+        try:
+            source.backup(snapshot)
+        finally:
+            source.close()
+        # the snapshot is served to every later candidate, so it must stay unmodified like the file
+        snapshot.execute("PRAGMA query_only = ON")
+        return snapshot
+
+    def evict(self):
+        sqlite_path, evicted = self.connections.popitem(last=False)
+        self.snapshot_sizes.pop(sqlite_path, None)
+        evicted.close()
+
+    def close(self):
+        while self.connections:
+            self.evict()
+
+
+def get_connection_pool() -> ConnectionPool:
+    # one pool per thread, sqlite3 connections must not be shared between threads
+    pool = getattr(exec_local, "pool", None)
+    if pool is None:
+        pool = ConnectionPool(EXEC_CONFIG["pool_size"], EXEC_CONFIG["mmap_size"], EXEC_CONFIG["snapshot_bytes"])
+        exec_local.pool = pool
+    return pool
+
+
+async def exec_on_db_(sqlite_path: str, query: str, timeout: float = None,
+                      max_instructions: int = None) -> Tuple[str, Any]:
     query = replace_cur_year(query)
-    cursor = get_cursor_from_path(sqlite_path)
+    if timeout is None:
+        timeout = EXEC_CONFIG["timeout"]
+    if max_instructions is None:
+        max_instructions = EXEC_CONFIG["max_instructions"]
+    connection = get_connection_pool().get(sqlite_path)
+
+    # the statement runs synchronously, so the budget is checked from SQLite's progress handler;
+    # returning non-zero from it aborts the statement with an "interrupted" OperationalError
+    deadline = time.monotonic() + timeout if timeout else None
+    budget = {"instructions": 0, "exceeded": None}
+
+    def check_budget():
+        budget["instructions"] += PROGRESS_INTERVAL
+        if max_instructions and budget["instructions"] > max_instructions:
+            budget["exceeded"] = f"instruction budget of {max_instructions}"
+        elif deadline is not None and time.monotonic() > deadline:
+            budget["exceeded"] = f"timeout of {timeout}s"
+        return budget["exceeded"] is not None
+
+    connection.set_progress_handler(check_budget, PROGRESS_INTERVAL)
+    cursor = connection.cursor()
     try:
         cursor.execute(query)
-        result = cursor.fetchall()
-        cursor.close()
-        cursor.connection.close()
-        return "result", result
+        result = fetch_result(cursor, EXEC_CONFIG["max_rows"], EXEC_CONFIG["max_bytes"])
+        outcome = "result", result
     except Exception as e:
+        if budget["exceeded"] is not None:
+            e = ExecutionTimeout(f"interrupted after exceeding the {budget['exceeded']}")
+        outcome = "exception", e
+    finally:
         cursor.close()
-        cursor.connection.close()
-        return "exception", e
+        connection.set_progress_handler(None, 0)
+
+    with threadLock:
+        exec_stats["executed"] += 1
+        if isinstance(outcome[1], ExecutionTimeout):
+            exec_stats["timeout"] += 1
+        elif isinstance(outcome[1], TruncatedResult):
+            exec_stats["oversized"] += 1
+        elif outcome[0] == "exception":
+            exec_stats["exception"] += 1
+    return outcome
 
 
 async def exec_on_db(
-        sqlite_path: str, query: str, process_id: str = "", timeout: int = TIMEOUT
+        sqlite_path: str, query: str, process_id: str = "", timeout: float = None
 ) -> Tuple[str, Any]:
     try:
-        return await asyncio.wait_for(exec_on_db_(sqlite_path, query), timeout)
-    except asyncio.TimeoutError:
-        return ('exception', TimeoutError)
+        return await exec_on_db_(sqlite_path, query, timeout)
     except Exception as e:
         return ("exception", e)
 
@@ -180,12 +492,19 @@ def remove_distinct(s):
     toks = [t.value for t in list(sqlparse.parse(s)[0].flatten())]
     return "".join([t for t in toks if t.lower() != "distinct"])
 
+# the database directories don't change during a run, so each one is listed only once
+@functools.lru_cache(maxsize=None)
+def get_sqlite_paths(db_dir: str) -> List[str]:
+    return [os.path.join(db_dir, basename) for basename in os.listdir(db_dir) if ".sqlite" in basename]
+
+
 def get_exec_output(
         db: str,
         sql: str,
         plug_value: bool = False,
         keep_distinct: bool = False,
         progress_bar_for_each_datapoint: bool = False,
+        return_fingerprint: bool = False,
 ):
     # post-process the prediction.
     # e.g. removing spaces between ">" and "="
@@ -196,22 +515,159 @@ def get_exec_output(
             # if sqlparse can't parse p_str, we should not even try to execute it
             sql = remove_distinct(sql)
         except Exception as e:
-            return "exception", []
+            return ("exception", [], None) if return_fingerprint else ("exception", [])
 
-    db_dir = os.path.dirname(db)
-    db_paths = [os.path.join(db_dir, basename) for basename in os.listdir(db_dir) if ".sqlite" in basename]
+    db_paths = get_sqlite_paths(os.path.dirname(db))
     # print(db_paths)
     if progress_bar_for_each_datapoint:
         ranger = tqdm.tqdm(db_paths)
     else:
         ranger = db_paths
     for db_path in ranger:
-        flag, sql_denotation = asyncio.run(exec_on_db(db_path, sql))
+        # the same normalized SQL on the same database content always gives the same output
+        cache = get_exec_cache()
+        cached = None
+        if cache is not None:
+            db_hash = get_db_hash(db_path)
+            cached = cache.get(db_hash, sql)
+        if cached is not None:
+            with threadLock:
+                exec_stats["cached"] += 1
+            flag, sql_denotation, fingerprint = cached
+            # the cache holds complete results, which may exceed the caps of this run
+            if flag == "result":
+                capped = cap_result(sql_denotation, EXEC_CONFIG["max_rows"], EXEC_CONFIG["max_bytes"])
+                if isinstance(capped, TruncatedResult):
+                    with threadLock:
+                        exec_stats["oversized"] += 1
+                    sql_denotation, fingerprint = capped, denotation_fingerprint(capped)
+        else:
+            flag, sql_denotation = asyncio.run(exec_on_db(db_path, sql))
+            fingerprint = None
+            if flag == "result" and (cache is not None or return_fingerprint):
+                fingerprint = denotation_fingerprint(sql_denotation)
+            # timeouts and truncation depend on the budget and caps of this run, so they are not cached
+            if cache is not None and not isinstance(sql_denotation, (ExecutionTimeout, TruncatedResult)):
+                cache.put(db_hash, sql, flag, sql_denotation, fingerprint)
         # print(sql_denotation)
+        if return_fingerprint:
+            return flag, sql_denotation, fingerprint
         return flag, sql_denotation
 
 
-def get_sqls(results, select_number, db_dir):
+class DenotationVoter(object):
+    """Cluster the candidate SQLs of one question by their execution results, one candidate at a time.
+
+    A candidate's cluster is found by the fingerprint of its denotation; result_eq is only run against the
+    centers with the same fingerprint, to rule out hash collisions. Only the denotation of each cluster center
+    is kept. The vote is the center of the largest cluster; among clusters of the same size the earliest one wins.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.candidates = []
+        self.clusters = []
+        self.center_denotations = []
+        # fingerprint -> ids of the clusters whose center has it
+        self.cluster_ids_by_fingerprint = defaultdict(list)
+
+    def add(self, sql):
+        flag, denotation, fingerprint = get_exec_output(
+            self.db_path,
+            sql,
+            return_fingerprint=True,
+        )
+        self.add_denotation(sql, flag, denotation, fingerprint)
+
+    def add_denotation(self, sql, flag, denotation, fingerprint=None):
+        """Add a candidate that was already executed elsewhere, e.g. in a worker process of get_sqls."""
+        self.candidates.append(sql)
+        if flag == "exception":
+            return
+        if fingerprint is None:
+            fingerprint = denotation_fingerprint(denotation)
+        cluster_ids = self.cluster_ids_by_fingerprint[fingerprint]
+        for id in cluster_ids:
+            if denotation_eq(self.center_denotations[id], denotation):
+                self.clusters[id].append(sql)
+                return
+        cluster_ids.append(len(self.clusters))
+        self.clusters.append([sql])
+        self.center_denotations.append(denotation)
+
+    def leader(self):
+        # sort is stable, so the earliest cluster wins ties
+        ranked = sorted(range(len(self.clusters)), key=lambda id: len(self.clusters[id]), reverse=True)
+        return ranked[0] if ranked else None
+
+    def is_decided(self, n_remaining):
+        """Whether n_remaining more candidates can no longer change the vote."""
+        leader = self.leader()
+        if leader is None:
+            return n_remaining == 0
+        lead = len(self.clusters[leader])
+        # a new cluster would be later than the leader, so it needs a strictly larger size
+        if n_remaining > lead:
+            return False
+        for id, cluster in enumerate(self.clusters):
+            if id == leader:
+                continue
+            # an earlier cluster overtakes the leader by tying it, a later one has to pass it
+            if id < leader and len(cluster) + n_remaining >= lead:
+                return False
+            if id > leader and len(cluster) + n_remaining > lead:
+                return False
+        return True
+
+    def vote(self, tie_breaker="earliest", rng=None):
+        """Return the first SQL of the largest cluster.
+
+        tie_breaker picks among clusters of the same size: the "earliest" one, the one with the "shortest" SQL
+        (earliest among those), or a "random" one drawn from rng.
+        """
+        if not self.clusters:
+            return self.candidates[0]
+        largest = max(len(cluster) for cluster in self.clusters)
+        tied = [cluster for cluster in self.clusters if len(cluster) == largest]
+        if tie_breaker == "shortest":
+            cluster = min(tied, key=lambda cluster: len(cluster[0]))
+        elif tie_breaker == "random":
+            cluster = (rng or random).choice(tied)
+        else:
+            cluster = tied[0]
+        return cluster[0]
+
+
+def init_exec_worker(config):
+    configure_execution(**config)
+
+
+def exec_group(db_path, sql_lists):
+    """Execute the candidates of several questions on the same database in a worker process of get_sqls.
+
+    Return the (flag, denotation, fingerprint) of every candidate and the execution stats of this call.
+    """
+    with threadLock:
+        exec_stats.clear()
+    denotations = []
+    for sqls in sql_lists:
+        question_denotations = []
+        for sql in sqls:
+            question_denotations.append(get_exec_output(db_path, sql, return_fingerprint=True))
+        denotations.append(question_denotations)
+    return denotations, get_exec_stats()
+
+
+TIE_BREAKERS = ["earliest", "shortest", "random"]
+
+
+def get_sqls(results, select_number, db_dir, num_workers=1, group_size=16, tie_breaker="earliest", seed=0):
+    """Vote one SQL per question among its first select_number candidates, see DenotationVoter.vote for tie_breaker.
+
+    With num_workers > 1 the candidates are executed in a process pool. Questions on the same database are sent
+    to a worker in groups of up to group_size, so the worker keeps that database's connection open; a question
+    is clustered as soon as the denotations of its group are back. Random tie-breaking is seeded per question,
+    so it doesn't depend on the order in which groups finish.
+    """
     db_ids = []
     all_p_sqls = []
     for item in results:
@@ -222,35 +678,42 @@ def get_sqls(results, select_number, db_dir):
             if i+1 == select_number:
                 break
         all_p_sqls.append(p_sqls)
-    chosen_p_sqls = []
-    for i, db_id in enumerate(tqdm.tqdm(db_ids)):
-        p_sqls = all_p_sqls[i]
-        db_path = f"{db_dir}/{db_id}/{db_id}"
-        cluster_sql_list = []
-        map_sql2denotation = {}
-        for sql in p_sqls:
-            flag, denotation = get_exec_output(
-                db_path,
-                sql,
-            )
-            if flag == "exception":
-                continue
-            map_sql2denotation[sql] = denotation
-            denotation_match = False
-
-            for id, cluster in enumerate(cluster_sql_list):
-                center_sql = cluster[0]
-                if result_eq(map_sql2denotation[center_sql], denotation, False):
-                    cluster_sql_list[id].append(sql)
-                    denotation_match = True
-                    break
-            if not denotation_match:
-                cluster_sql_list.append([sql])
-        cluster_sql_list.sort(key=lambda x: len(x), reverse=True)
-        if not cluster_sql_list:
-            chosen_p_sqls.append(p_sqls[0])
-        else:
-            chosen_p_sqls.append(cluster_sql_list[0][0])
+    chosen_p_sqls = [None] * len(db_ids)
+
+    if num_workers <= 1 or len(db_ids) <= 1:
+        for i, db_id in enumerate(tqdm.tqdm(db_ids)):
+            p_sqls = all_p_sqls[i]
+            db_path = f"{db_dir}/{db_id}/{db_id}"
+            voter = DenotationVoter(db_path)
+            for sql in p_sqls:
+                voter.add(sql)
+            chosen_p_sqls[i] = voter.vote(tie_breaker, random.Random(f"{seed}-{i}"))
+    else:
+        question_ids_by_db = defaultdict(list)
+        for i, db_id in enumerate(db_ids):
+            question_ids_by_db[db_id].append(i)
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_exec_worker,
+                                 initargs=(dict(EXEC_CONFIG),)) as executor:
+            futures = dict()
+            for db_id, question_ids in question_ids_by_db.items():
+                db_path = f"{db_dir}/{db_id}/{db_id}"
+                for start in range(0, len(question_ids), group_size):
+                    group = question_ids[start:start + group_size]
+                    future = executor.submit(exec_group, db_path, [all_p_sqls[i] for i in group])
+                    futures[future] = db_path, group
+            progress = tqdm.tqdm(total=len(db_ids))
+            for future in as_completed(futures):
+                db_path, group = futures[future]
+                denotations, stats = future.result()
+                with threadLock:
+                    exec_stats.update(stats)
+                for i, question_denotations in zip(group, denotations):
+                    voter = DenotationVoter(db_path)
+                    for sql, (flag, denotation, fingerprint) in zip(all_p_sqls[i], question_denotations):
+                        voter.add_denotation(sql, flag, denotation, fingerprint)
+                    chosen_p_sqls[i] = voter.vote(tie_breaker, random.Random(f"{seed}-{i}"))
+                progress.update(len(group))
+            progress.close()
 
     print("save chosen sqls and results...")
 
@@ -167,19 +167,64 @@ def get_sql_for_database(path_db=None, cur=None):
     return [_[0][0] for _ in sqls]
 
 
-def get_tokenizer(tokenizer_type: str):
-    return 0
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_type, use_fast=False)
-    return tokenizer
+class ApproximateTokenizer(object):
+    """About 4 characters per token, used when no real tokenizer can be loaded (e.g. offline without a local file)."""
+    CHARS_PER_TOKEN = 4
+
+    def encode(self, string: str):
+        return range(-(-len(string) // self.CHARS_PER_TOKEN))
+
+
+def load_tiktoken_file(tokenizer_type: str, path: str):
+    """The tiktoken encoding of an openai model, with its BPE ranks read from a local .tiktoken file."""
+    import tiktoken
+    import tiktoken_ext.openai_public as openai_public
+    from tiktoken.load import load_tiktoken_bpe
+
+    encoding_name = tiktoken.model.encoding_name_for_model(tokenizer_type)
+    # the constructors download their BPE file, so point their loader to the local file instead
+    download = openai_public.load_tiktoken_bpe
+    openai_public.load_tiktoken_bpe = lambda *args, **kwargs: load_tiktoken_bpe(path)
+    try:
+        return tiktoken.Encoding(**openai_public.ENCODING_CONSTRUCTORS[encoding_name]())
+    finally:
+        openai_public.load_tiktoken_bpe = download
+
+
+def get_tokenizer(tokenizer_type: str, tokenizer_path: str = None):
+    """Return a tokenizer: tiktoken for openai models, transformers for the others.
+
+    tokenizer_path is a local .tiktoken file (e.g. cl100k_base.tiktoken) for an openai model, or a local
+    transformers tokenizer directory, so nothing has to be downloaded. Without it, an openai encoding that can't
+    be downloaded falls back to ApproximateTokenizer.
+    """
+    if tokenizer_path is not None and os.path.isdir(tokenizer_path):
+        return AutoTokenizer.from_pretrained(tokenizer_path, use_fast=False)
+    import tiktoken
+    try:
+        tiktoken.model.encoding_name_for_model(tokenizer_type)
+    except KeyError:
+        return AutoTokenizer.from_pretrained(tokenizer_type, use_fast=False)
+    if tokenizer_path is not None:
+        return load_tiktoken_file(tokenizer_type, tokenizer_path)
+    try:
+        return tiktoken.encoding_for_model(tokenizer_type)
+    except Exception as e:
+        print(f"Could not load the tiktoken encoding of {tokenizer_type} ({type(e).__name__}), "
+              f"prompt tokens are estimated from their length; pass --tokenizer_path to count them exactly")
+        return ApproximateTokenizer()
 
 
 def count_tokens(string: str, tokenizer_type: str=None, tokenizer=None):
-    return 0
-    # if tokenizer is None:
-    #     tokenizer = get_tokenizer(tokenizer_type)
-    #
-    # n_tokens = len(tokenizer.encode(string))
-    # return n_tokens
+    if tokenizer is None:
+        tokenizer = get_tokenizer(tokenizer_type)
+
+    if hasattr(tokenizer, "encode_ordinary"):
+        # tiktoken, do not fail on special tokens such as <|endoftext|> that appear as plain text
+        n_tokens = len(tokenizer.encode_ordinary(string))
+    else:
+        n_tokens = len(tokenizer.encode(string))
+    return n_tokens
 
 
 def sql_normalization(sql):
@@ -0,0 +1,164 @@
+import hashlib
+import os
+
+import numpy as np
+
+
+def top_k(scores, k: int, mask=None):
+    """Indexes of the k smallest scores (among mask), ordered by score and then by index like a stable sort."""
+    candidates = np.flatnonzero(mask) if mask is not None else np.arange(len(scores))
+    if k < len(candidates):
+        values = scores[candidates]
+        # keep every tie of the k-th score, so the cut below is the same as on the fully sorted order
+        kth = np.partition(values, k - 1)[k - 1]
+        candidates = candidates[values <= kth]
+    order = np.lexsort((candidates, scores[candidates]))
+    return candidates[order][:k]
+
+
+def pairwise_distances(queries, vectors, metric: str = "euclidean"):
+    """Distances (smaller is closer): euclidean, or the negative cosine similarity."""
+    queries = np.asarray(queries, dtype=np.float32)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if metric == "cosine":
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return -(queries @ vectors.T)
+    squared = (queries ** 2).sum(axis=1)[:, None] + (vectors ** 2).sum(axis=1)[None, :] - 2 * queries @ vectors.T
+    return np.sqrt(np.maximum(squared, 0))
+
+
+class ExactIndex(object):
+    """Brute-force search: the distances to every vector, computed in blocks of queries of max_block_bytes."""
+    name = "exact"
+
+    def __init__(self, vectors, distance_fn=None, metric: str = "euclidean", max_block_bytes: int = 256 << 20):
+        self.vectors = vectors
+        self.distance_fn = distance_fn or (lambda queries: pairwise_distances(queries, self.vectors, metric))
+        self.max_block_bytes = max_block_bytes
+
+    def search(self, queries, k: int):
+        """Return the indexes and distances of the k closest vectors of every query, closest first."""
+        k = min(k, len(self.vectors))
+        indexes = np.empty((len(queries), k), dtype=np.int64)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        block_size = max(1, self.max_block_bytes // (8 * len(self.vectors)))
+        for start in range(0, len(queries), block_size):
+            block_distances = self.distance_fn(np.asarray(queries[start:start + block_size]))
+            if start == 0:
+                # keep the precision of distance_fn, the selectors compare these distances to thresholds
+                distances = np.empty((len(queries), k), dtype=block_distances.dtype)
+            for i, row in enumerate(block_distances):
+                indexes[start + i] = top_k(row, k)
+                distances[start + i] = row[indexes[start + i]]
+        return indexes, distances
+
+
+class IVFIndex(object):
+    """Inverted-file index: vectors are bucketed by their nearest k-means centroid, and a query only scans
+    the buckets of its n_probe nearest centroids (more if these hold fewer than k vectors).
+
+    The centroids and buckets are saved to path (a .npz) together with a hash of the indexed vectors,
+    and rebuilt when the vectors change.
+    """
+    name = "ivf"
+
+    def __init__(self, vectors, metric: str = "euclidean", n_lists: int = None, n_probe: int = 8,
+                 path: str = None, n_iter: int = 20, train_size: int = 64, seed: int = 0):
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.metric = metric
+        self.n_lists = min(n_lists or max(1, int(4 * np.sqrt(len(self.vectors)))), len(self.vectors))
+        self.n_probe = n_probe
+        self.path = path
+        self.train_size = train_size
+        self.digest = hashlib.blake2b(self.vectors.tobytes(), digest_size=16).hexdigest()
+        if not self.load():
+            self.build(n_iter, seed)
+            self.save()
+
+    def normalize(self, vectors):
+        # on unit vectors the euclidean order is the cosine order, so k-means works for both metrics
+        if self.metric == "cosine":
+            return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def assign(self, vectors):
+        """The nearest centroid of every vector."""
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        # |v - c|^2 without the |v|^2 term, which doesn't change the nearest centroid
+        squared_norms = (self.centroids ** 2).sum(axis=1)
+        block_size = max(1, (64 << 20) // (8 * len(self.centroids)))
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            assignments[start:start + block_size] = (squared_norms - 2 * block @ self.centroids.T).argmin(axis=1)
+        return assignments
+
+    def build(self, n_iter: int, seed: int):
+        rng = np.random.RandomState(seed)
+        vectors = self.normalize(self.vectors)
+        # k-means on a sample of train_size vectors per list, then every vector goes to its nearest centroid
+        sample = vectors[rng.permutation(len(vectors))[:self.train_size * self.n_lists]]
+        self.centroids = sample[:self.n_lists].copy()
+        for _ in range(n_iter):
+            assignments = self.assign(sample)
+            counts = np.bincount(assignments, minlength=self.n_lists)
+            sums = np.stack([np.bincount(assignments, weights=sample[:, d], minlength=self.n_lists)
+                             for d in range(sample.shape[1])], axis=1)
+            # an empty list gets a random vector as its new centroid
+            empty = counts == 0
+            sums[empty] = sample[rng.randint(len(sample), size=empty.sum())]
+            self.centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        assignments = self.assign(vectors)
+        self.list_indexes = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.searchsorted(assignments[self.list_indexes], np.arange(self.n_lists + 1))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        saved = np.load(self.path)
+        if str(saved["digest"]) != self.digest or str(saved["metric"]) != self.metric or len(saved["centroids"]) != self.n_lists:
+            return False
+        self.centroids = saved["centroids"]
+        self.list_indexes = saved["list_indexes"]
+        self.list_offsets = saved["list_offsets"]
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, digest=self.digest, metric=self.metric, centroids=self.centroids,
+                 list_indexes=self.list_indexes, list_offsets=self.list_offsets)
+        os.replace(tmp_path, self.path)
+
+    def search(self, queries, k: int):
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.vectors))
+        list_sizes = np.diff(self.list_offsets)
+        indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        probes = pairwise_distances(self.normalize(queries), self.centroids)
+        for i, query in enumerate(queries):
+            lists = np.argsort(probes[i], kind="stable")
+            # probe n_probe lists, and more while they hold fewer than k vectors
+            n_probe = max(self.n_probe, np.searchsorted(np.cumsum(list_sizes[lists]), k) + 1)
+            lists = lists[:n_probe]
+            candidates = np.concatenate([self.list_indexes[self.list_offsets[list_id]:self.list_offsets[list_id + 1]]
+                                         for list_id in lists])
+            candidate_distances = pairwise_distances(query[None], self.vectors[candidates], self.metric)[0]
+            best = top_k(candidate_distances, k)
+            # only with k over all the vectors can the row still be short, the rest of it stays at -1
+            indexes[i, :len(best)] = candidates[best]
+            distances[i, :len(best)] = candidate_distances[best]
+        return indexes, distances
+
+
+INDEX_TYPES = ["exact", "ivf"]
+
+
+def recall_at_k(approximate_indexes, exact_indexes):
+    """Share of the exact k nearest neighbours that the approximate search found, averaged over queries."""
+    hits = [len(np.intersect1d(approximate, exact)) / len(exact)
+            for approximate, exact in zip(approximate_indexes, exact_indexes) if len(exact)]
+    return float(np.mean(hits)) if hits else 1.
@@ -0,0 +1,73 @@
+import argparse
+import os
+import time
+
+from utils.journal import Journal
+from utils.post_process import clean_sql, get_sqls, configure_execution, get_exec_stats, TIE_BREAKERS
+
+
+def load_samples(journal_path):
+    """Return the questions of an ask_llm.py journal in order, each with its db_id and cleaned samples."""
+    records = Journal(journal_path).load()
+    results = []
+    for index in sorted(records):
+        responses = records[index]["responses"]
+        # with n = 1 the journal holds a single response
+        if isinstance(responses, str):
+            responses = [responses]
+        results.append({
+            "db_id": records[index]["db_id"],
+            "p_sqls": [clean_sql(response) for response in responses]
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Vote again on the samples that ask_llm.py saved in its journal")
+    parser.add_argument("--samples", type=str, required=True,
+                        help="Journal of an ask_llm.py run, [question]/RESULTS_MODEL-[model].txt.journal")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Result file, next to the journal and named after n and the tie-breaker by default")
+    parser.add_argument("--n", type=int, default=5, help="Number of samples per question to vote among")
+    parser.add_argument("--tie_breaker", type=str, choices=TIE_BREAKERS, default="earliest",
+                        help="How to choose among clusters of the same size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random tie-breaker")
+    parser.add_argument("--db_dir", type=str, default="dataset/spider/database")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of processes executing candidates")
+    parser.add_argument("--group_size", type=int, default=16, help="Questions on the same database sent to a worker at once")
+    parser.add_argument("--db_mmap_size", type=int, default=None, help="Bytes of each database to memory-map")
+    parser.add_argument("--db_snapshot_bytes", type=int, default=None,
+                        help="Bytes of databases each worker keeps in memory, larger ones are read from disk")
+    parser.add_argument("--exec_max_rows", type=int, default=None, help="Rows of a candidate's result kept, 0 for no limit")
+    parser.add_argument("--exec_max_bytes", type=int, default=None,
+                        help="Approximate bytes of a candidate's result kept, 0 for no limit")
+    parser.add_argument("--exec_cache", type=str, default=None, help="SQLite file caching execution results across runs")
+    parser.add_argument("--exec_timeout", type=float, default=None, help="Seconds a candidate may run, 0 for no limit")
+    parser.add_argument("--exec_max_instructions", type=int, default=None,
+                        help="SQLite VM instructions a candidate may run, 0 for no limit")
+    args = parser.parse_args()
+
+    configure_execution(mmap_size=args.db_mmap_size, snapshot_bytes=args.db_snapshot_bytes,
+                        timeout=args.exec_timeout, max_instructions=args.exec_max_instructions,
+                        max_rows=args.exec_max_rows, max_bytes=args.exec_max_bytes, cache_path=args.exec_cache)
+
+    out_file = args.output
+    if out_file is None:
+        base = args.samples[:-len(".journal")] if args.samples.endswith(".journal") else args.samples
+        base = base[:-len(".txt")] if base.endswith(".txt") else base
+        out_file = f"{base}_VOTE-{args.n}-{args.tie_breaker.upper()}.txt"
+
+    results = load_samples(args.samples)
+    print(f"Vote on {len(results)} questions with {args.num_workers} workers")
+    start_time = time.time()
+    chosen_sqls = get_sqls(results, args.n, args.db_dir, num_workers=args.num_workers, group_size=args.group_size,
+                           tie_breaker=args.tie_breaker, seed=args.seed)
+    with open(out_file, "w") as f:
+        for sql in chosen_sqls:
+            f.write(sql + "\n")
+
+    stats = get_exec_stats()
+    print(f"Write {len(chosen_sqls)} SQLs to {out_file} in {time.time() - start_time:.1f}s, "
+          f"executed {stats.get('executed', 0)} candidates, {stats.get('exception', 0)} failed, "
+          f"{stats.get('timeout', 0)} timed out, {stats.get('oversized', 0)} oversized, "
+          f"{stats.get('cached', 0)} taken from the execution cache")